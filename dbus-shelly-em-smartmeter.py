@@ -12,24 +12,44 @@ else:
     from gi.repository import GLib as gobject
 import sys
 import time
-import requests # for http GET
-import configparser # for config/ini file
+from concurrent.futures import ThreadPoolExecutor
  
 # our own packages from victron
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '/opt/victronenergy/dbus-systemcalc-py/ext/velib_python'))
 from vedbus import VeDbusService
 
+# our own packages
+from shelly_config import ConfigWatcher, loadSettings
+from shelly_energy import EnergyIntegrator
+from shelly_fieldmap import PHASES, FieldMap
+from shelly_http import AsyncFetcher, HttpStatusError, createHttpClient, isTimeout
+from shelly_logging import setupLogging
+from shelly_publish import DbusPublisher
+from shelly_push import CoiotListener, MqttListener, SHEM_SENSORS, coiotSensorMap, emetersFromValues
+from shelly_scheduler import PollScheduler
+from shelly_snapshot import SNAPSHOT_INTERVAL, Snapshot
+from shelly_stats import STATS_PATHS, LagProbe, MetricsServer, Stats
+
+
+def dbusconnection():
+  import dbus # vedbus imported it already, here so the tools run with their stand-in vedbus without dbus
+  
+  # every VeDbusService needs its own private bus connection, otherwise the
+  # services of one process would share (and overwrite) the same object tree
+  return dbus.SessionBus(private=True) if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus(private=True)
+
 
 class DbusShellyemService:
-  def __init__(self, servicename, paths, productname='Shelly EM', connection='Shelly EM HTTP JSON service'):
-    config = self._getConfig()
-    deviceinstance = int(config['DEFAULT']['Deviceinstance'])
-    customname = config['DEFAULT']['CustomName']
-    
-    self._dbusservice = VeDbusService("{}.http_{:02d}".format(servicename, deviceinstance))
+  def __init__(self, servicename, deviceinstance, customname, role, phases, serial, paths, position=0, deadbands=(), heartbeat=10, history=None, energy=None, productname='Shelly EM', connection='Shelly EM HTTP JSON service'):
+    self._servicename = "{}.http_{:02d}".format(servicename, deviceinstance)
+    self._dbusservice = VeDbusService(self._servicename, bus=dbusconnection())
     self._paths = paths
+    self._fieldmap = FieldMap(phases) # the clamps of the meter -> D-Bus paths
+    self._energyPaths = tuple(path for path in self._fieldmap.paths if '/Energy/' in path)
+    self._history = history           # MeterHistory or None
+    self._energy = energy             # EnergyIntegrator or None
     
-    logging.debug("%s /DeviceInstance = %d" % (servicename, deviceinstance))
+    logging.debug("%s /DeviceInstance = %d", servicename, deviceinstance)
     
     # Create the management objects, as specified in the ccgx dbus-api document
     self._dbusservice.add_path('/Mgmt/ProcessName', __file__)
@@ -48,169 +68,512 @@ class DbusShellyemService:
     self._dbusservice.add_path('/Latency', None)    
     self._dbusservice.add_path('/FirmwareVersion', 0.1)
     self._dbusservice.add_path('/HardwareVersion', 0)
-    self._dbusservice.add_path('/Connected', 1)
-    self._dbusservice.add_path('/Role', 'grid')
-    self._dbusservice.add_path('/Position', 0) # normaly only needed for pvinverter
-    self._dbusservice.add_path('/Serial', self._getShellySerial())
+    self._dbusservice.add_path('/Connected', 0) # until the first sample
+    self._dbusservice.add_path('/Role', role)
+    self._dbusservice.add_path('/Position', position) # normaly only needed for pvinverter
+    self._dbusservice.add_path('/Serial', serial)
     self._dbusservice.add_path('/UpdateIndex', 0)
+    for path in STATS_PATHS:
+      self._dbusservice.add_path(path, None)
     
-    # add path values to dbus
+    # add path values to dbus, totals and the phases of this meter
     for path, settings in self._paths.items():
+      if path.startswith('/Ac/L') and path not in self._fieldmap.paths:
+        continue
       self._dbusservice.add_path(
         path, settings['initial'], gettextcallback=settings['textformat'], writeable=True, onchangecallback=self._handlechangedvalue)
 
+ 
+    # only changed values are sent on D-Bus
+    self._publisher = DbusPublisher(self._dbusservice, deadbands, heartbeat)
+    self._statsPublisher = DbusPublisher(self._dbusservice)
+
     # last update
     self._lastUpdate = 0
+    self._lastValues = {}
+ 
+  def _signOfLife(self):
+    logging.info("Last _update() call of %s: %s", self._servicename, self._lastUpdate)
+    logging.info("Last '/Ac/Power' of %s: %s", self._servicename, self._dbusservice['/Ac/Power'])
+ 
+  def _update(self, meter_data, timestamp, energy=True):
+    #our clamps of the Shelly em
+    values = self._fieldmap.values(meter_data['emeters'])
+    
+    #a virtual meter does not know the counters of all its clamps yet, the energy stays as it is
+    if not energy:
+      for path in self._energyPaths:
+        del values[path]
+    
+    #smooth energy and power between the samples of the Shelly
+    elif self._energy is not None:
+      self._energy.apply(timestamp, values)
+    
+    #send changed data to DBus
+    changed = self._publisher.publish(values)
+  
+    #logging
+    logging.debug("%s (/Ac/Power): %s", self._servicename, values['/Ac/Power'])
+    logging.debug("%s (/Ac/Energy/Forward): %s", self._servicename, values.get('/Ac/Energy/Forward'))
+    logging.debug("%s (/Ac/Energy/Revers): %s", self._servicename, values.get('/Ac/Energy/Reverse'))
+    logging.debug("%s paths changed: %d", self._servicename, changed)
 
-    # add _update function 'timer'
-    gobject.timeout_add(250, self._update) # pause 250ms before the next request
+    #update lastupdate vars
+    self._lastUpdate = time.time()              
+    self._lastValues = values
+    
+    if self._history is not None:
+      self._history.add(timestamp, values)
+ 
+  def _restore(self, values):
+    # energy of the snapshot, shown until the Shelly answers - power and current may be long gone, they stay unknown
+    values = dict((path, values[path] if path in self._energyPaths and path in values else None) for path in self._fieldmap.paths)
+    self._publisher.publish(values)
+    self._lastValues = values
+ 
+  def _setSerial(self, serial):
+    self._dbusservice['/Serial'] = serial
+ 
+  def _publishStats(self, values):
+    # not a new sample, /UpdateIndex stays
+    self._statsPublisher.publish(values, updateIndex=False)
+ 
+  def _setConnected(self, connected):
+    self._dbusservice['/Connected'] = connected
+ 
+  def _handlechangedvalue(self, path, value):
+    logging.debug("someone else updated %s to %s", path, value)
+    return True # accept the change
+
+
+def meterservice(settings, meter, paths, serial, history=None, executor=None, productname='Shelly EM', connection='Shelly EM HTTP JSON service'):
+  # the D-Bus service of one [METER:<name>] section
+  energy = None
+  if settings.energyIntegration or settings.powerFilter != 'none':
+    path = os.path.join(settings.stateDirectory, '%s.energy.json' % (meter.name))
+    energy = EnergyIntegrator(meter.name, meter.phases, path, settings.powerFilter, settings.powerFilterAlpha, settings.powerFilterWindow, executor)
+  
+  return DbusShellyemService(
+    servicename='com.victronenergy.%s' % (meter.role),
+    deviceinstance=meter.deviceinstance,
+    customname=meter.customname,
+    role=meter.role,
+    phases=meter.phases,
+    serial=serial,
+    paths=paths,
+    position=meter.position,
+    deadbands=settings.deadbands,
+    heartbeat=settings.publishHeartbeat,
+    history=history.meter(meter.name) if history is not None else None,
+    energy=energy,
+    productname=productname,
+    connection=connection)
+
+
+# failed requests in a row after which the meters are reported as disconnected
+OFFLINE_AFTER = 3
+
+# seconds between attempts to read the serial of a Shelly that did not answer
+IDENTIFY_RETRY = 30
+
+# seconds between searches on the network for a Shelly that does not answer
+RESOLVE_INTERVAL = 300
+
+# seconds on /status before /emeter/<i> is tried again, with Endpoint=auto
+EMETER_RETRY = 300
+
+
+class ShellyemPoller:
+  """Polls one Shelly EM ([ONPREMISE] or [ONPREMISE:<name>] section of
+  config.ini) once per tick and fans the response out to one
+  DbusShellyemService per [METER:<name>] section of this device and to
+  the virtual meters with clamps of this device."""
+  def __init__(self, settings, device, paths, executor, coiot=None, history=None, lag=None, discovery=None, aggregates=(), recorder=None, productname='Shelly EM', connection='Shelly EM HTTP JSON service'):
+    self._settings = settings
+    self._discovery = discovery
+    self._configuredHost = device.host
+    self._resolvedHost = None # host found by discovery instead of the configured one
+    self._lastResolve = 0
+    if not device.host and discovery is not None and discovery.host(device.mac):
+      self._resolvedHost = discovery.host(device.mac)
+      device = self._withHost(device, self._resolvedHost)
+    self._device = device
+    self._stats = Stats(lag)
+    self._recorder = recorder # Recorder of the responses or None
+    self._client = self._getShellyClient(settings, device)
+    self._emeterFailures = 0 # /emeter/<i> failed while /status worked
+    self._emeterFallback = 0 # time of the fall back to /status
+    self._lastPower = {}      # channel -> power of the previous sample
+    self._lastPush = 0        # time of the last pushed sample
+    self._lastRequest = 0     # time the last HTTP request was started
+    self._lastSnapshot = 0    # time the snapshot was last written
+    self._connected = False   # /Connected of the services
+    self._executor = executor
+    self._coiot = coiot
+    self._coiotSensors = SHEM_SENSORS
+    self._pushStarted = False
+    self._aggregates = tuple(aggregate for aggregate in aggregates if device.name in aggregate.devices)
+    
+    # last known good state, the services are registered without waiting for the Shelly
+    os.makedirs(settings.stateDirectory, exist_ok=True)
+    self._snapshot = Snapshot(os.path.join(settings.stateDirectory, '%s.snapshot.json' % (device.name or 'ONPREMISE')))
+    self._serial = self._snapshot.serial
+    
+    self._services = [meterservice(settings, meter, paths, self._serial or '', history, executor, productname, connection) for meter in device.meters]
+    for meter, service in zip(device.meters, self._services):
+      if meter.name in self._snapshot.meters:
+        service._restore(self._snapshot.meters[meter.name])
+    
+    # fetch on the worker pool shared by all devices, results come back to _publish() via the main loop
+    self._fetcher = AsyncFetcher(self._getShellyData, self._publish, executor)
+    
+    # add _update function 'timer', adapted to the load and backing off while the Shelly is unreachable
+    self._scheduler = PollScheduler(self._update, *self._getSchedulerSettings(settings))
+    self._scheduler.start()
+    
+    # serial and CoIoT description are read in the background, and again until the Shelly answers
+    self._identify = AsyncFetcher(self._identifyShelly, self._onIdentified, executor)
+    if device.host:
+      self._identify.request()
+    else:
+      self._resolve()
+    
+    # samples pushed by the Shelly, HTTP polling becomes the slow fallback
+    if self._serial:
+      self._startPush()
+    
+    # timings and counters on /Latency and /Mgmt/Stats/*
+    if settings.statsInterval > 0:
+      gobject.timeout_add_seconds(settings.statsInterval, self._publishStats)
     
     # add _signOfLife 'timer' to get feedback in log every 5minutes
-    gobject.timeout_add(self._getSignOfLifeInterval()*60*1000, self._signOfLife)
+    if settings.signOfLifeLog > 0:
+      gobject.timeout_add(settings.signOfLifeLog*60*1000, self._signOfLife)
  
   def _getShellySerial(self):
-    meter_data = self._getShellyData()  
+    # only /status contains the MAC
+    meter_data = self._client.getJson('/status')
     
     if not meter_data['mac']:
         raise ValueError("Response does not contain 'mac' attribute")
     
     serial = meter_data['mac']
     return serial
- 
- 
-  def _getConfig(self):
-    config = configparser.ConfigParser()
-    config.read("%s/config.ini" % (os.path.dirname(os.path.realpath(__file__))))
-    return config;
- 
- 
-  def _getSignOfLifeInterval(self):
-    config = self._getConfig()
-    value = config['DEFAULT']['SignOfLifeLog']
-    
-    if not value: 
-        value = 0
+  
+  
+  def _identifyShelly(self):
+    # on the worker thread
+    sensors = self._getCoiotSensors() if self._device.push == 'coiot' else None
+    return (self._getShellySerial(), sensors)
+  
+  
+  def _onIdentified(self, data, error, started):
+    if error is not None:
+      logging.warning("Can not read the serial of Shelly EM %s, retrying in %d s: %s", self._device.host, IDENTIFY_RETRY, error)
+      gobject.timeout_add_seconds(IDENTIFY_RETRY, lambda: self._identify.request() and False)
+      return
     
-    return int(value)
+    serial, sensors = data
+    if sensors:
+      self._coiotSensors = sensors
+    if serial != self._serial:
+      if self._serial:
+        logging.warning("Serial of Shelly EM %s changed from %s to %s", self._device.host, self._serial, serial)
+      self._serial = serial
+      for service in self._services:
+        service._setSerial(serial)
+    if self._discovery is not None:
+      self._discovery.remember(serial, self._device.host)
+    if not self._pushStarted:
+      self._startPush()
+  
+  
+  def _withHost(self, device, host):
+    return device._replace(host=host, baseUrl="http://%s" % (host))
+  
+  
+  def _resolve(self):
+    # look for the Shelly by its MAC, in the background
+    mac = self._serial or self._device.mac
+    if self._discovery is None or not mac:
+      return
+    self._lastResolve = time.time()
+    logging.info("Looking for Shelly EM %s on the network", mac)
+    self._discovery.resolve(mac, self._device.host, self._onResolved)
+  
+  
+  def _onResolved(self, host):
+    if host is None:
+      logging.warning("Shelly EM %s not found on the network, trying again in %d s", self._serial or self._device.mac, RESOLVE_INTERVAL)
+      return
+    if host != self._device.host:
+      logging.info("Shelly EM %s found at %s, was %s", self._serial or self._device.mac, host, self._device.host or 'unknown')
+      self._resolvedHost = host
+      self._device = self._withHost(self._device, host)
+      self._client = self._getShellyClient(self._settings, self._device)
+      self._emeterFailures = 0
+    if not self._serial:
+      self._identify.request()
+  
+  
+  def _startPush(self):
+    device = self._device
+    if device.push == 'coiot':
+      self._coiot.subscribe(self._serial, self._onCoiot)
+    elif device.push == 'mqtt':
+      topic = device.mqttTopic or 'shellies/shellyem-%s' % (self._serial[-6:])
+      self._mqtt = MqttListener(device.mqttHost, device.mqttPort, topic, device.channels, self._onPush)
+    self._pushStarted = True
   
   
-  def _getShellyStatusUrl(self):
-    config = self._getConfig()
-    accessType = config['DEFAULT']['AccessType']
+  def _getCoiotSensors(self):
+    # the CoIoT description tells which sensor id is which value of which clamp
+    try:
+      sensors = coiotSensorMap(self._client.getJson('/cit/d'))
+      if sensors:
+        return sensors
+    except Exception as e:
+      logging.warning("Can not read /cit/d of Shelly EM %s, using the sensor ids of the Shelly EM: %s", self._device.host, e)
+    return SHEM_SENSORS
+  
+  
+  def _getShellyClient(self, settings, device):
+    recorder = self._recorder.forDevice(device.name) if self._recorder is not None else None
+    return createHttpClient(settings.httpClient, device.baseUrl, device.username, device.password, device.timeout, self._stats, recorder)
+  
+  
+  def _getSchedulerSettings(self, settings):
+    return (settings.pollInterval, settings.minPollInterval, settings.maxPollInterval, settings.powerChangeThreshold, settings.maxBackoff)
+  
+  
+  def _applySettings(self, settings):
+    old, oldDevice = self._settings, self._device
+    device = ([device for device in settings.devices if device.name == oldDevice.name] or [None])[0]
+    if device is None:
+      logging.warning("Shelly EM %s was removed from config.ini, it is polled until the service is restarted", oldDevice.host)
+      return
     
-    if accessType == 'OnPremise': 
-        URL = "http://%s:%s@%s/status" % (config['ONPREMISE']['Username'], config['ONPREMISE']['Password'], config['ONPREMISE']['Host'])
-        URL = URL.replace(":@", "")
+    configured = device.host
+    if self._resolvedHost is not None and configured in ('', self._configuredHost):
+      # config.ini still has the host the Shelly moved away from
+      device = self._withHost(device, self._resolvedHost)
     else:
-        raise ValueError("AccessType %s is not supported" % (config['DEFAULT']['AccessType']))
+      self._resolvedHost = None
+    self._configuredHost = configured
     
-    return URL
+    if (device.baseUrl, device.username, device.password, device.timeout, settings.httpClient) != (oldDevice.baseUrl, oldDevice.username, oldDevice.password, oldDevice.timeout, old.httpClient):
+      # swap the client in one assignment, a request already running on the worker finishes with the old one
+      logging.info("Shelly EM connection changed to %s", device.baseUrl)
+      self._client = self._getShellyClient(settings, device)
     
- 
-  def _getShellyData(self):
-    URL = self._getShellyStatusUrl()
-    meter_r = requests.get(url = URL)
+    if device.endpoint != oldDevice.endpoint:
+      self._emeterFailures = 0
+    
+    self._scheduler.configure(*self._getSchedulerSettings(settings))
     
-    # check for response
-    if not meter_r:
-        raise ConnectionError("No response from Shelly EM - %s" % (URL))
+    if (settings.deadbands, settings.publishHeartbeat) != (old.deadbands, old.publishHeartbeat):
+      for service in self._services:
+        service._publisher.configure(settings.deadbands, settings.publishHeartbeat)
     
-    meter_data = meter_r.json()     
+    if device.meters != oldDevice.meters or device.channels != oldDevice.channels or settings.signOfLifeLog != old.signOfLifeLog or \
+       (settings.energyIntegration, settings.powerFilter, settings.powerFilterAlpha, settings.powerFilterWindow) != (old.energyIntegration, old.powerFilter, old.powerFilterAlpha, old.powerFilterWindow) or \
+       (device.push, device.mqttHost, device.mqttPort, device.mqttTopic) != (oldDevice.push, oldDevice.mqttHost, oldDevice.mqttPort, oldDevice.mqttTopic):
+      logging.warning("Changed meters, push, energy integration or SignOfLifeLog in config.ini take effect after a restart of the service")
     
-    # check for Json
-    if not meter_data:
-        raise ValueError("Converting response to JSON failed")
+    # what only takes effect after a restart stays as it was started, the push listener runs with it
+    self._settings, self._device = settings, device._replace(meters=oldDevice.meters, channels=oldDevice.channels, push=oldDevice.push,
+                                                             mqttHost=oldDevice.mqttHost, mqttPort=oldDevice.mqttPort, mqttTopic=oldDevice.mqttTopic)
     
+ 
+  def _useEmeterEndpoint(self):
+    endpoint = self._device.endpoint
+    if endpoint == 'auto' and self._emeterFailures >= 3 and time.time() - self._emeterFallback >= EMETER_RETRY:
+      # it may have been a passing error of the Shelly, one more try - if it fails, back to /status for EMETER_RETRY
+      self._emeterFailures = 2
+    return endpoint == 'emeter' or (endpoint == 'auto' and self._emeterFailures < 3)
+  
+  
+  def _getShellyData(self):
+    if self._useEmeterEndpoint():
+      try:
+        # the small per clamp documents, only for the clamps we publish
+        device = self._device
+        emeters = [None] * (device.channels[-1] + 1)
+        for channel in device.channels:
+          emeters[channel] = self._client.getJson('/emeter/%d' % (channel))
+        self._emeterFailures = 0
+        return {'emeters': emeters}
+      except (HttpStatusError, ValueError) as e:
+        # only if the Shelly answered, an unreachable one would cost a second timeout in the same tick
+        logging.debug("Request of /emeter failed, falling back to /status: %s", e)
+        meter_data = self._client.getJson('/status')
+        
+        # /status works but /emeter does not, stop trying it for a while after a few times
+        self._emeterFailures += 1
+        if self._emeterFailures == 3:
+          self._emeterFallback = time.time()
+          logging.info("Shelly EM %s does not answer on /emeter/<i>, using /status for %d s", self._device.host, EMETER_RETRY)
+        return meter_data
     
-    return meter_data
+    return self._client.getJson('/status')
  
  
   def _signOfLife(self):
     logging.info("--- Start: sign of life ---")
-    logging.info("Last _update() call: %s" % (self._lastUpdate))
-    logging.info("Last '/Ac/Power': %s" % (self._dbusservice['/Ac/Power']))
+    for service in self._services:
+      service._signOfLife()
+    logging.info("HTTP connections to Shelly EM %s - new: %d, reused: %d", self._device.host, *self._client.connectionStats())
+    logging.info("Shelly EM %s - %s", self._device.host, self._stats.summary())
     logging.info("--- End: sign of life ---")
     return True
  
+  def _publishStats(self):
+    values = self._stats.values()
+    for service in self._services:
+      service._publishStats(values)
+    return True
+ 
+  def _isPushFresh(self):
+    return self._device.push != 'none' and time.time() - self._lastPush < self._device.pushTimeout
+ 
+  def _onCoiot(self, payload):
+    values = {}
+    for entry in payload.get('G', []):
+      sensor = self._coiotSensors.get(entry[1])
+      if sensor is not None:
+        values.setdefault(sensor[0], {})[sensor[1]] = entry[2]
+    
+    meter_data = emetersFromValues(values, self._device.channels)
+    if meter_data is None:
+      logging.debug("CoIoT frame of Shelly EM %s does not contain all values", self._device.host)
+      return
+    self._onPush(meter_data)
+ 
+  def _onPush(self, meter_data):
+    # same publishing path as a polled sample
+    self._lastPush = time.time()
+    self._publish(meter_data, None, self._lastPush, pushed=True)
+ 
   def _update(self):   
-    try:
-       #get data from Shelly em
-       meter_data = self._getShellyData()
-      
-      
-       
-       #send data to DBus
-       self._dbusservice['/Ac/L1/Voltage'] = meter_data['emeters'][0]['voltage']
+    # the Shelly has only a MAC in config.ini and was not found on the network yet
+    if not self._device.host:
+      self._scheduler.skip()
+      if time.time() - self._lastResolve >= RESOLVE_INTERVAL:
+        self._resolve()
+      return
+    
+    # while pushed samples arrive only poll now and then to catch up on anything missed
+    if self._isPushFresh() and time.time() - self._lastRequest < self._device.pushPollInterval / 1000:
+      self._scheduler.skip()
+      return
+    self._lastRequest = time.time()
+    
+    # never block the main loop on the Shelly - the request runs on the worker thread
+    if not self._fetcher.request():
+      self._stats.count('skipped')
+      logging.debug("Previous request to Shelly EM still running, skipping this tick")
  
-       current = meter_data['emeters'][1]['power'] / meter_data['emeters'][0]['voltage']
-       self._dbusservice['/Ac/L1/Current'] = current
-
-       #change to [1] for second probe in Shelly EM
-       self._dbusservice['/Ac/L1/Power'] = meter_data['emeters'][1]['power']
-       self._dbusservice['/Ac/L1/Energy/Forward'] = (meter_data['emeters'][1]['total']/1000)
-       self._dbusservice['/Ac/L1/Energy/Reverse'] = (meter_data['emeters'][1]['total_returned']/1000)    
+  def _getPowerChange(self, meter_data):
+    change = 0
+    for channel in self._device.channels:
+      power = meter_data['emeters'][channel]['power']
+      change = max(change, abs(power - self._lastPower.get(channel, power)))
+      self._lastPower[channel] = power
+    return change
+ 
+  def _saveSnapshot(self, timestamp):
+    if not self._serial or timestamp - self._lastSnapshot < SNAPSHOT_INTERVAL:
+      return
+    self._lastSnapshot = timestamp
+    meters = dict((meter.name, service._lastValues) for meter, service in zip(self._device.meters, self._services))
+    # the file is written on the worker, not on the main loop
+    self._executor.submit(self._snapshot.save, self._serial, meters, timestamp)
+ 
+  def _publish(self, meter_data, error, started, pushed=False):
+    try:
+       if error is not None:
+         raise error
        
-        
-       #self._dbusservice['/Ac/Power'] = meter_data['total_power'] # positive: consumption, negative: feed into grid
-       #self._dbusservice['/Ac/L2/Voltage'] = meter_data['emeters'][1]['voltage']
-       #self._dbusservice['/Ac/L2/Current'] = meter_data['emeters'][1]['current']
-       #self._dbusservice['/Ac/L2/Power'] = meter_data['emeters'][1]['power']
-       #self._dbusservice['/Ac/L2/Energy/Forward'] = (meter_data['emeters'][1]['total']/1000)
-       #self._dbusservice['/Ac/L2/Energy/Reverse'] = (meter_data['emeters'][1]['total_returned']/1000) 
-
-       #self._dbusservice['/Ac/L3/Voltage'] = meter_data['emeters'][2]['voltage']
-       #self._dbusservice['/Ac/L3/Current'] = meter_data['emeters'][2]['current']
-       #self._dbusservice['/Ac/L3/Power'] = meter_data['emeters'][2]['power']
-       #self._dbusservice['/Ac/L3/Energy/Forward'] = (meter_data['emeters'][2]['total']/1000)
-       #self._dbusservice['/Ac/L3/Energy/Reverse'] = (meter_data['emeters'][2]['total_returned']/1000) 
+       #one response for all services
+       publishStarted = time.perf_counter()
+       for service in self._services:
+         service._update(meter_data, started)
+       for aggregate in self._aggregates:
+         aggregate.add(self._device.name, meter_data, started)
+       self._stats.record('publish', time.perf_counter() - publishStarted)
+       if not pushed:
+         # a pushed sample has no request, its 0 ms would pull the tick time of the polls down
+         self._stats.record('tick', time.time() - started)
        
-       self._dbusservice['/Ac/Current'] = self._dbusservice['/Ac/L1/Current']  
-       self._dbusservice['/Ac/Power'] = self._dbusservice['/Ac/L1/Power']
+       if self._scheduler.failures > 0:
+         logging.info("Shelly EM %s is reachable again after %d failed requests", self._device.host, self._scheduler.failures)
+       if not self._connected:
+         self._connected = True
+         for service in self._services:
+           service._setConnected(1)
        
-       #+ self._dbusservice['/Ac/L2/Energy/Forward'] + self._dbusservice['/Ac/L3/Energy/Forward']
-       #+ self._dbusservice['/Ac/L2/Energy/Reverse'] + self._dbusservice['/Ac/L3/Energy/Reverse'] 
+       self._saveSnapshot(started)
        
-
-       self._dbusservice['/Ac/Energy/Forward'] = self._dbusservice['/Ac/L1/Energy/Forward']
-       self._dbusservice['/Ac/Energy/Reverse'] = self._dbusservice['/Ac/L1/Energy/Reverse'] 
-
-      
-     
-       #logging
-       logging.debug("House Consumption (/Ac/Power): %s" % (self._dbusservice['/Ac/Power']))
-       logging.debug("House Forward (/Ac/Energy/Forward): %s" % (self._dbusservice['/Ac/Energy/Forward']))
-       logging.debug("House Reverse (/Ac/Energy/Revers): %s" % (self._dbusservice['/Ac/Energy/Reverse']))
+       self._scheduler.completed(True, self._getPowerChange(meter_data))
        logging.debug("---");
-       
-       # increment UpdateIndex - to show that new data is available
-       index = self._dbusservice['/UpdateIndex'] + 1  # increment index
-       if index > 255:   # maximum value of the index
-         index = 0       # overflow from 255 to 0
-       self._dbusservice['/UpdateIndex'] = index
-
-       #update lastupdate vars
-       self._lastUpdate = time.time()              
     except Exception as e:
-       logging.critical('Error at %s', '_update', exc_info=e)
+       self._stats.count('errors')
+       if isTimeout(e):
+         self._stats.count('timeouts')
        
-    # return true, otherwise add_timeout will be removed from GObject - see docs http://library.isr.ist.utl.pt/docs/pygtk2reference/gobject-functions.html#function-gobject--timeout-add
-    return True
- 
-  def _handlechangedvalue(self, path, value):
-    logging.debug("someone else updated %s to %s" % (path, value))
-    return True # accept the change
+       # full traceback only for the first error in a row, the scheduler backs off from here
+       failures = self._scheduler.failures + 1
+       if failures == 1:
+         logging.critical('Error at %s', '_update', exc_info=e)
+       else:
+         logging.debug("Request %d in a row to Shelly EM %s failed: %s", failures, self._device.host, e)
+       
+       if failures == OFFLINE_AFTER:
+         logging.warning("Shelly EM %s is unreachable, setting /Connected = 0", self._device.host)
+         self._connected = False
+         for service in self._services:
+           service._setConnected(0)
+       
+       # DHCP may have given the Shelly a new IP
+       if failures >= OFFLINE_AFTER and time.time() - self._lastResolve >= RESOLVE_INTERVAL:
+         self._resolve()
+       
+       delay = self._scheduler.completed(False)
+       logging.debug("Next request to Shelly EM %s in %d ms", self._device.host, delay)
  
 
 
+def dbuspaths():
+  # the paths every service publishes, with their text formatting
+  _kwh = lambda p, v: (str(round(v, 2)) + 'KWh')
+  _a = lambda p, v: (str(round(v, 1)) + 'A')
+  _w = lambda p, v: (str(round(v, 1)) + 'W')
+  _v = lambda p, v: (str(round(v, 1)) + 'V')   
+  
+  paths = {
+    '/Ac/Energy/Forward': {'initial': 0, 'textformat': _kwh}, # energy bought from the grid
+    '/Ac/Energy/Reverse': {'initial': 0, 'textformat': _kwh}, # energy sold to the grid
+    '/Ac/Power': {'initial': 0, 'textformat': _w},
+    
+    '/Ac/Current': {'initial': 0, 'textformat': _a},
+    '/Ac/Voltage': {'initial': 0, 'textformat': _v},
+  }
+  
+  for phase in PHASES:
+    paths.update({
+      '/Ac/%s/Voltage' % (phase): {'initial': 0, 'textformat': _v},
+      '/Ac/%s/Current' % (phase): {'initial': 0, 'textformat': _a},
+      '/Ac/%s/Power' % (phase): {'initial': 0, 'textformat': _w},
+      '/Ac/%s/Energy/Forward' % (phase): {'initial': 0, 'textformat': _kwh},
+      '/Ac/%s/Energy/Reverse' % (phase): {'initial': 0, 'textformat': _kwh},
+    })
+  
+  return paths
+
+
 def main():
-  #configure logging
-  logging.basicConfig(      format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S',
-                            level=logging.INFO,
-                            handlers=[
-                                logging.FileHandler("%s/current.log" % (os.path.dirname(os.path.realpath(__file__)))),
-                                logging.StreamHandler()
-                            ])
+  #configure logging, written on its own thread
+  setupLogging("%s/current.log" % (os.path.dirname(os.path.realpath(__file__))))
  
   try:
       logging.info("Start");
@@ -219,39 +582,50 @@ def main():
       # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
       DBusGMainLoop(set_as_default=True)
      
-      #formatting 
-      _kwh = lambda p, v: (str(round(v, 2)) + 'KWh')
-      _a = lambda p, v: (str(round(v, 1)) + 'A')
-      _w = lambda p, v: (str(round(v, 1)) + 'W')
-      _v = lambda p, v: (str(round(v, 1)) + 'V')   
-     
-      #start our main-service com.victronenergy.pvinverter instead of com.victronenergy.grid
-      pvac_output = DbusShellyemService(
-        servicename='com.victronenergy.pvinverter',
-        paths={
-          '/Ac/Energy/Forward': {'initial': 0, 'textformat': _kwh}, # energy bought from the grid
-          '/Ac/Energy/Reverse': {'initial': 0, 'textformat': _kwh}, # energy sold to the grid
-          '/Ac/Power': {'initial': 0, 'textformat': _w},
-          
-          '/Ac/Current': {'initial': 0, 'textformat': _a},
-          '/Ac/Voltage': {'initial': 0, 'textformat': _v},
-          
-          '/Ac/L1/Voltage': {'initial': 0, 'textformat': _v},
-          #'/Ac/L2/Voltage': {'initial': 0, 'textformat': _v},
-          #'/Ac/L3/Voltage': {'initial': 0, 'textformat': _v},
-          '/Ac/L1/Current': {'initial': 0, 'textformat': _a},
-          #'/Ac/L2/Current': {'initial': 0, 'textformat': _a},
-          #'/Ac/L3/Current': {'initial': 0, 'textformat': _a},
-          '/Ac/L1/Power': {'initial': 0, 'textformat': _w},
-          #'/Ac/L2/Power': {'initial': 0, 'textformat': _w},
-          #'/Ac/L3/Power': {'initial': 0, 'textformat': _w},
-          '/Ac/L1/Energy/Forward': {'initial': 0, 'textformat': _kwh},
-          #'/Ac/L2/Energy/Forward': {'initial': 0, 'textformat': _kwh},
-          #'/Ac/L3/Energy/Forward': {'initial': 0, 'textformat': _kwh},
-          '/Ac/L1/Energy/Reverse': {'initial': 0, 'textformat': _kwh},
-          #'/Ac/L2/Energy/Reverse': {'initial': 0, 'textformat': _kwh},
-          #'/Ac/L3/Energy/Reverse': {'initial': 0, 'textformat': _kwh},
-        })
+      configfile = "%s/config.ini" % (os.path.dirname(os.path.realpath(__file__)))
+      settings = loadSettings(configfile)
+      paths = dbuspaths()
+      
+      #start one poller per Shelly, each one feeds the services of its meters
+      #all of them share one bounded pool of threads for the HTTP requests, one CoIoT socket and the history
+      executor = ThreadPoolExecutor(max_workers=max(1, settings.maxWorkers))
+      coiot = CoiotListener(settings.coiotPort) if any(device.push == 'coiot' for device in settings.devices) else None
+      history = None
+      if settings.history:
+        from shelly_history import History # optional features are only imported when they are configured
+        history = History(settings.historyDirectory, settings.historySocket, executor, settings.historyRawSamples, settings.historyFlushInterval)
+      discovery = None
+      if settings.discovery or any(not device.host for device in settings.devices):
+        from shelly_discovery import Discovery
+        discovery = Discovery(os.path.join(settings.stateDirectory, 'registry.json'), settings.discoverySubnet, executor=executor)
+      aggregates = []
+      if settings.aggregates:
+        from shelly_aggregate import AggregateMeter
+        for meter in settings.aggregates:
+          service = meterservice(settings, meter, paths, 'virtual-%s' % (meter.name), history, executor,
+                                 productname='Shelly EM virtual meter', connection='Shelly EM virtual meter of %d clamps' % (len(meter.sources)))
+          os.makedirs(settings.stateDirectory, exist_ok=True)
+          aggregates.append(AggregateMeter(meter, service, settings.aggregateWindow, settings.aggregateStale,
+                                           os.path.join(settings.stateDirectory, '%s.sources.json' % (meter.name)), executor))
+      recorder = None
+      if settings.recordFile:
+        from shelly_record import Recorder
+        recorder = Recorder(settings.recordFile)
+      # the probe wakes the main loop 10 times per second, only for someone who reads it
+      lag = LagProbe().histogram if settings.statsInterval > 0 or settings.metricsPort > 0 else None
+      # without Discovery=1 only the Shellys configured by Mac alone are searched
+      pollers = [ShellyemPoller(settings, device, paths, executor, coiot, history, lag,
+                                discovery if settings.discovery or not device.host else None, aggregates, recorder) for device in settings.devices]
+      if settings.metricsPort > 0:
+        MetricsServer(settings.metricsPort, tuple((poller._device.name or 'ONPREMISE', poller._stats) for poller in pollers))
+      
+      # reload config.ini only when it changed
+      def _applySettings(settings):
+        for poller in pollers:
+          poller._applySettings(settings)
+        for aggregate in aggregates:
+          aggregate.configure(settings.aggregateWindow, settings.aggregateStale)
+      configWatcher = ConfigWatcher(configfile, _applySettings)
      
       logging.info('Connected to dbus, and switching over to gobject.MainLoop() (= event based)')
       mainloop = gobject.MainLoop()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# import normal packages
+import logging
+import time
+from gi.repository import GLib
+
+# our own packages
+from shelly_energy import PERSIST_INTERVAL
+from shelly_snapshot import loadJson, saveJson
+
+
+class AggregateMeter:
+  """One virtual meter ([METER:<name>] with Sources=) made of clamps of
+  several Shellys, published as one D-Bus service.
+
+  The pollers of the Shellys run independently and hand every sample to
+  add(). The aggregate is published as soon as every fresh Shelly sent a
+  sample since the last publish, or `window` ms after the first one did -
+  a slow Shelly does not hold back the others, its last sample is used.
+  Clamps on the same phase are summed (power, current, energy), their
+  voltage is averaged.
+
+  A Shelly without sample for `stale` seconds is missing: its power and
+  current count as 0 and its energy stays at its last counters, so the
+  energy never goes backwards. /Connected is 0 only while all of them are
+  missing. At startup the aggregate waits up to `stale` seconds for every
+  Shelly before it is published without the missing ones.
+
+  The last counters of every clamp are kept in a JSON file (written on the
+  executor), a Shelly missing after a restart counts with them. The energy
+  paths are only published once the counters of all clamps are known, so
+  a Shelly joining or leaving never moves the summed energy."""
+  def __init__(self, meter, service, window=200, stale=10, path=None, executor=None):
+    self.meter = meter
+    self._path = path
+    self._executor = executor
+    self._counters = loadJson(path) if path else {} # 'device:channel' -> [total, total_returned] in Wh
+    self._saved = 0
+    self.devices = tuple(sorted(set(device for device, channel, phase in meter.sources)))
+    self._service = service
+    # per virtual channel (index in meter.phases) the (device, channel) clamps on its phase
+    self._clamps = tuple(tuple((device, channel) for device, channel, source in meter.sources if source == phase) for index, phase in meter.phases)
+    self._samples = {}       # device -> (timestamp of the request, emeters)
+    self._received = dict((device, time.time()) for device in self.devices) # start counts as received, for the wait at startup
+    self._pending = set()    # devices with a sample since the last publish
+    self._missing = set()
+    self._connected = False
+    self._timer = None
+    self.configure(window, stale)
+    GLib.timeout_add_seconds(1, self._check)
+
+  def configure(self, window, stale):
+    self._window = window
+    self._stale = stale
+
+  def add(self, device, meter_data, timestamp):
+    """Takes a sample of one Shelly, on the main loop."""
+    self._samples[device] = (timestamp, meter_data['emeters'])
+    self._received[device] = time.time()
+    self._pending.add(device)
+    if self._pending.issuperset(self._getFresh()):
+      self._publish()
+    elif self._timer is None:
+      self._timer = GLib.timeout_add(self._window, self._onWindow)
+
+  def _getFresh(self, now=None):
+    now = now if now is not None else time.time()
+    return set(device for device in self.devices if now - self._received[device] < self._stale)
+
+  def _onWindow(self):
+    self._timer = None
+    # nothing published at startup before every Shelly answered once or is missing
+    fresh = self._getFresh()
+    if fresh and all(device in self._samples for device in fresh):
+      self._publish()
+    return False
+
+  def _check(self):
+    # all Shellys gone, no add() notices it
+    if self._connected and not self._getFresh():
+      self._setMissing(set(self.devices))
+      self._saveCounters(time.time())
+      self._connected = False
+      self._service._setConnected(0)
+    return True
+
+  def _setMissing(self, missing):
+    for device in sorted(missing - self._missing):
+      logging.warning("Shelly EM %s of virtual meter %s is missing, its power counts as 0", device or 'ONPREMISE', self.meter.name)
+    for device in sorted(self._missing - missing):
+      logging.info("Shelly EM %s of virtual meter %s is back", device or 'ONPREMISE', self.meter.name)
+    self._missing = missing
+
+  def _publish(self):
+    if self._timer is not None:
+      GLib.source_remove(self._timer)
+      self._timer = None
+    fresh = self._getFresh()
+    missing = set(self.devices) - fresh
+    if missing - self._missing:
+      self._saved = 0 # keep the counters of the Shelly that went missing
+    self._setMissing(missing)
+    self._pending.clear()
+
+    timestamp = max(self._samples[device][0] for device in fresh)
+    emeters, energy = self._getEmeters(fresh)
+    self._service._update({'emeters': emeters}, timestamp, energy)
+    if timestamp - self._saved >= PERSIST_INTERVAL:
+      self._saveCounters(timestamp)
+    if not self._connected:
+      self._connected = True
+      self._service._setConnected(1)
+
+  def _saveCounters(self, timestamp):
+    self._saved = timestamp
+    if self._path is None:
+      return
+    counters = dict((key, list(value)) for key, value in self._counters.items())
+    if self._executor is not None:
+      self._executor.submit(saveJson, self._path, counters)
+    else:
+      saveJson(self._path, counters)
+
+  def _getEmeters(self, fresh):
+    """Returns (emeters, whether the counters of all clamps are known)."""
+    # one emeter per phase, like a Shelly with one clamp per phase
+    emeters = []
+    energy = True
+    for clamps in self._clamps:
+      emeter = {'power': 0, 'total': 0, 'total_returned': 0}
+      voltages, currents = [], []
+      for device, channel in clamps:
+        key = '%s:%d' % (device, channel)
+        if device in self._samples:
+          clamp = self._samples[device][1][channel]
+          self._counters[key] = (clamp['total'], clamp['total_returned'])
+        if key in self._counters:
+          # a missing Shelly counts with its last counters, from before a restart too
+          emeter['total'] += self._counters[key][0]
+          emeter['total_returned'] += self._counters[key][1]
+        else:
+          energy = False
+        if device not in self._samples:
+          continue
+        if device in fresh:
+          emeter['power'] += clamp['power']
+          voltages.append(clamp['voltage'])
+          currents.append(clamp.get('current'))
+      emeter['voltage'] = sum(voltages) / len(voltages) if voltages else 0
+      if currents and None not in currents:
+        emeter['current'] = sum(currents) # 3EM, the EM has no current and it is derived from power and voltage
+      emeters.append(emeter)
+    return emeters, energy
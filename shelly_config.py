@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+# import normal packages
+import configparser # for config/ini file
+import ipaddress
+import logging
+import os
+from collections import namedtuple
+from gi.repository import GLib
+
+# our own packages
+from shelly_energy import FILTERS
+from shelly_fieldmap import PHASES
+from shelly_http import HTTP_CLIENTS
+
+
+ROLES = ('grid', 'pvinverter', 'genset')
+ENDPOINTS = ('auto', 'emeter', 'status')
+PUSH = ('none', 'coiot', 'mqtt')
+
+# parsed and validated config.ini - immutable, a reload builds a new one
+Settings = namedtuple('Settings', [
+  'accessType',
+  'signOfLifeLog',   # minutes
+  'pollInterval',    # ms, first interval, adapted between min and max
+  'minPollInterval', # ms
+  'maxPollInterval', # ms
+  'powerChangeThreshold', # W per sample above which we poll at minPollInterval
+  'maxBackoff',      # ms, longest delay after failed requests
+  'maxWorkers',      # threads shared by all devices for the HTTP requests
+  'httpClient',      # requests or stdlib
+  'coiotPort',       # UDP port the Shellys send their CoIoT frames to
+  'publishHeartbeat', # seconds
+  'deadbands',       # tuple of (path pattern, absolute, relative)
+  'history',         # keep the history of the meters
+  'historyDirectory', # history files, one per meter
+  'historySocket',   # UNIX socket of the query interface, '' for none
+  'historyRawSamples', # raw samples per meter kept in RAM
+  'historyFlushInterval', # seconds between writes of the history to flash
+  'energyIntegration', # integrate the power between the counter updates of the Shelly
+  'powerFilter',     # none, ewma or median
+  'powerFilterAlpha', # weight of the newest sample of the ewma
+  'powerFilterWindow', # samples of the median
+  'stateDirectory',  # small files the service keeps across restarts
+  'discovery',       # look for a Shelly that does not answer any more by its MAC
+  'discoverySubnet', # CIDR probed for Shellys, '' for the /24 of the last known host
+  'statsInterval',   # seconds between updates of /Latency and /Mgmt/Stats/*, 0 for never
+  'metricsPort',     # TCP port of the text metrics on 127.0.0.1, 0 for none
+  'aggregateWindow', # ms a virtual meter waits for the samples of all its Shellys
+  'aggregateStale',  # seconds without sample after which a Shelly of a virtual meter is missing
+  'recordFile',      # gzip file every response of the Shellys is appended to, '' for none
+  'devices',         # tuple of DeviceSettings
+  'aggregates',      # tuple of MeterSettings of the virtual meters
+])
+
+# one [ONPREMISE] or [ONPREMISE:<name>] section - one Shelly
+DeviceSettings = namedtuple('DeviceSettings', [
+  'name',            # '' for [ONPREMISE]
+  'baseUrl',         # http://<host>, precomputed once
+  'host',            # '' until found by the MAC
+  'mac',             # e.g. 84CCA8B15999, optional with Host
+  'username',
+  'password',
+  'timeout',         # (connect, read) seconds
+  'endpoint',        # auto, emeter or status
+  'channels',        # sorted tuple of the clamps used by the meters and virtual meters
+  'push',            # none, coiot or mqtt
+  'pushTimeout',     # seconds without pushed sample until we poll at the normal interval again
+  'pushPollInterval', # ms, slow HTTP poll while pushed samples arrive
+  'mqttHost',
+  'mqttPort',
+  'mqttTopic',       # e.g. shellies/shellyem-B15999, '' derives it from the MAC
+  'meters',          # tuple of MeterSettings
+])
+
+# one [METER:<name>] section - one D-Bus service
+MeterSettings = namedtuple('MeterSettings', [
+  'name',
+  'device',          # name of the DeviceSettings, '' for [ONPREMISE], None for a virtual meter
+  'phases',          # tuple of (channel, phase), e.g. ((1, 'L1'),) - of a virtual meter (index, phase)
+  'sources',         # virtual meter: tuple of (device, channel, phase), () otherwise
+  'role',
+  'deviceinstance',
+  'customname',
+  'position',
+])
+
+
+def _getInt(section, key, default=None):
+  value = section.get(key, default)
+  if value is None or value == '':
+    if default is None:
+      raise ValueError("[%s] %s is missing" % (section.name, key))
+    value = default
+  try:
+    return int(value)
+  except ValueError:
+    raise ValueError("[%s] %s is not a number: %s" % (section.name, key, value))
+
+
+def _getFloat(section, key, default):
+  value = section.get(key, '') or default
+  try:
+    return float(value)
+  except ValueError:
+    raise ValueError("[%s] %s is not a number: %s" % (section.name, key, value))
+
+
+def _loadPhases(section):
+  # Channels=0,1,2 for a Shelly 3EM (L1, L2, L3), Channel=1 with optional Phase=L2 for one clamp
+  if section.get('Channels'):
+    try:
+      channels = [int(channel) for channel in section['Channels'].split(',')]
+    except ValueError:
+      raise ValueError("[%s] Channels is not a list of numbers: %s" % (section.name, section['Channels']))
+    if not 0 < len(channels) <= len(PHASES):
+      raise ValueError("[%s] Channels must list 1 to %d clamps" % (section.name, len(PHASES)))
+    return tuple(zip(channels, PHASES))
+
+  phase = section.get('Phase', '') or 'L1'
+  if phase not in PHASES:
+    raise ValueError("[%s] Phase %s is not supported" % (section.name, phase))
+  return ((_getInt(section, 'Channel'), phase),)
+
+
+def _loadSources(section):
+  # Sources=0, garage:0, garage:1:L2 - [<device>:]<channel>[:<phase>] of a virtual meter, clamps on the same phase are summed
+  sources = []
+  for source in section['Sources'].split(','):
+    parts = [part.strip() for part in source.split(':')]
+    if len(parts) == 1:
+      parts.insert(0, '') # clamp of [ONPREMISE]
+    if len(parts) == 2:
+      parts.append('L1')
+    if len(parts) != 3 or not parts[1].isdigit():
+      raise ValueError("[%s] Sources entry %s is not [<device>:]<channel>[:<phase>]" % (section.name, source.strip()))
+    device, channel, phase = parts
+    if phase not in PHASES:
+      raise ValueError("[%s] Phase %s is not supported" % (section.name, phase))
+    if (device, int(channel)) in [(d, c) for d, c, p in sources]:
+      raise ValueError("[%s] Sources lists clamp %s twice" % (section.name, source.strip()))
+    sources.append((device, int(channel), phase))
+  return tuple(sources)
+
+
+def _loadMeter(section):
+  role = section.get('Role', '')
+  if role not in ROLES:
+    raise ValueError("Role %s of [%s] is not supported" % (role, section.name))
+
+  sources = _loadSources(section) if section.get('Sources') else ()
+  if sources:
+    # one virtual clamp per phase
+    phases = tuple(enumerate(phase for phase in PHASES if phase in [p for d, c, p in sources]))
+  else:
+    phases = _loadPhases(section)
+
+  return MeterSettings(
+    name=section.name.split(':', 1)[1],
+    device=section.get('Device', '') if not sources else None,
+    phases=phases,
+    sources=sources,
+    role=role,
+    deviceinstance=_getInt(section, 'Deviceinstance'),
+    customname=section.get('CustomName', ''),
+    position=_getInt(section, 'Position', 0))
+
+
+def _loadDeadbands(path):
+  # [DEADBAND] /Ac/*Power = 1 (absolute) or /Ac/*Power = 0.5% (relative to the last published value)
+  # read by its own parser that keeps the case of the D-Bus paths (the other keys are case-insensitive)
+  # and takes the % literally
+  config = configparser.ConfigParser(interpolation=None)
+  config.optionxform = str
+  config.read(path)
+  if not config.has_section('DEADBAND'):
+    return ()
+
+  deadbands = []
+  for pattern, value in config.items('DEADBAND'):
+    if not pattern.startswith('/'):
+      continue # inherited from [DEFAULT]
+    try:
+      if value.endswith('%'):
+        deadbands.append((pattern, 0, float(value[:-1]) / 100))
+      else:
+        deadbands.append((pattern, float(value), 0))
+    except ValueError:
+      raise ValueError("[DEADBAND] %s is not a number: %s" % (pattern, value))
+  return tuple(deadbands)
+
+
+def _loadDevice(section, meters):
+  name = section.name.split(':', 1)[1] if ':' in section.name else ''
+  mac = section.get('Mac', '').replace(':', '').upper()
+  if not section.get('Host') and not mac:
+    raise ValueError("[%s] Host or Mac is missing" % (section.name))
+
+  endpoint = section.get('Endpoint', '') or 'auto'
+  if endpoint not in ENDPOINTS:
+    raise ValueError("[%s] Endpoint %s is not supported" % (section.name, endpoint))
+
+  push = section.get('Push', '') or 'none'
+  if push not in PUSH:
+    raise ValueError("[%s] Push %s is not supported" % (section.name, push))
+
+  channels = set(channel for meter in meters if meter.device == name for channel, phase in meter.phases)
+  channels.update(channel for meter in meters for device, channel, phase in meter.sources if device == name)
+  meters = tuple(meter for meter in meters if meter.device == name)
+  return DeviceSettings(
+    name=name,
+    baseUrl="http://%s" % (section.get('Host', '')),
+    host=section.get('Host', ''),
+    mac=mac,
+    username=section.get('Username', ''),
+    password=section.get('Password', ''),
+    timeout=(_getFloat(section, 'ConnectTimeout', 2), _getFloat(section, 'ReadTimeout', 2)),
+    endpoint=endpoint,
+    channels=tuple(sorted(channels)),
+    push=push,
+    pushTimeout=_getFloat(section, 'PushTimeout', 60),
+    pushPollInterval=_getInt(section, 'PushPollInterval', 30000),
+    mqttHost=section.get('MqttHost', '') or '127.0.0.1',
+    mqttPort=_getInt(section, 'MqttPort', 1883),
+    mqttTopic=section.get('MqttTopic', ''),
+    meters=meters)
+
+
+def _migrateMeter(config, path):
+  # config.ini of the versions with one meter: Deviceinstance and CustomName in [DEFAULT], published clamp 1 as pvinverter on L1
+  if any(section.startswith('METER:') for section in config.sections()) or not config['DEFAULT'].get('Deviceinstance'):
+    return
+  logging.warning("%s has no [METER:<name>] section, publishing clamp 1 as pvinverter with Deviceinstance and CustomName of [DEFAULT] "
+                  "as before - move them to a [METER:pvinverter] section, see README", path)
+  config['METER:pvinverter'] = {'Role': 'pvinverter', 'Channel': '1', 'Phase': 'L1', 'Position': '0'}
+
+
+def loadSettings(path):
+  """Reads and validates config.ini, raises ValueError if it is not usable."""
+  config = configparser.ConfigParser()
+  if not config.read(path):
+    raise ValueError("Can not read %s" % (path))
+
+  accessType = config['DEFAULT'].get('AccessType', '')
+  if accessType != 'OnPremise':
+    raise ValueError("AccessType %s is not supported" % (accessType))
+
+  _migrateMeter(config, path)
+  meters = tuple(_loadMeter(config[section]) for section in config.sections() if section.startswith('METER:'))
+  if not meters:
+    raise ValueError("config.ini does not contain any [METER:<name>] section")
+
+  instances = [(meter.role, meter.deviceinstance) for meter in meters]
+  if len(set(instances)) != len(instances):
+    raise ValueError("Deviceinstance is used twice for the same Role")
+
+  # [ONPREMISE] and any number of [ONPREMISE:<name>], meters refer to them with Device=<name>
+  devices = tuple(_loadDevice(config[section], meters) for section in config.sections()
+                  if section == 'ONPREMISE' or section.startswith('ONPREMISE:'))
+  for meter in meters:
+    for name in ([meter.device] if meter.device is not None else [device for device, channel, phase in meter.sources]):
+      if name not in [device.name for device in devices]:
+        raise ValueError("Device %s of [METER:%s] has no [ONPREMISE%s] section" % (name, meter.name, ':' + name if name else ''))
+  devices = tuple(device for device in devices if device.channels)
+
+  default = config['DEFAULT']
+  pollInterval = _getInt(default, 'PollInterval', 250)
+  minPollInterval = _getInt(default, 'MinPollInterval', pollInterval)
+  maxPollInterval = _getInt(default, 'MaxPollInterval', pollInterval)
+  if not 0 < minPollInterval <= maxPollInterval:
+    raise ValueError("MinPollInterval must be > 0 and <= MaxPollInterval")
+  if _getInt(default, 'HistoryRawSamples', 3600) < 1 or _getInt(default, 'HistoryFlushInterval', 300) < 1:
+    raise ValueError("HistoryRawSamples and HistoryFlushInterval must be > 0")
+  httpClient = default.get('HttpClient', '') or 'requests'
+  if httpClient not in HTTP_CLIENTS:
+    raise ValueError("HttpClient %s is not supported" % (httpClient))
+  powerFilter = default.get('PowerFilter', '') or 'none'
+  if powerFilter not in FILTERS:
+    raise ValueError("PowerFilter %s is not supported" % (powerFilter))
+  if not 0 < _getFloat(default, 'PowerFilterAlpha', 0.5) <= 1 or _getInt(default, 'PowerFilterWindow', 5) < 1:
+    raise ValueError("PowerFilterAlpha must be > 0 and <= 1, PowerFilterWindow > 0")
+  discoverySubnet = default.get('DiscoverySubnet', '')
+  try:
+    discoverySubnet = str(ipaddress.ip_network(discoverySubnet, strict=False)) if discoverySubnet else ''
+  except ValueError:
+    raise ValueError("DiscoverySubnet %s is not a subnet like 192.168.1.0/24" % (discoverySubnet))
+  if _getInt(default, 'AggregateWindow', 200) < 1 or _getFloat(default, 'AggregateStale', 10) <= 0:
+    raise ValueError("AggregateWindow and AggregateStale must be > 0")
+
+  return Settings(
+    accessType=accessType,
+    signOfLifeLog=_getInt(default, 'SignOfLifeLog', 0),
+    pollInterval=pollInterval,
+    minPollInterval=minPollInterval,
+    maxPollInterval=maxPollInterval,
+    powerChangeThreshold=_getFloat(default, 'PowerChangeThreshold', 20),
+    maxBackoff=_getInt(default, 'MaxBackoff', 60000),
+    maxWorkers=_getInt(default, 'MaxWorkers', min(4, len(devices))),
+    httpClient=httpClient,
+    coiotPort=_getInt(default, 'CoiotPort', 5683),
+    publishHeartbeat=_getFloat(default, 'PublishHeartbeat', 10),
+    deadbands=_loadDeadbands(path),
+    history=_getInt(default, 'History', 0) == 1,
+    historyDirectory=default.get('HistoryDirectory', '') or os.path.join(os.path.dirname(os.path.realpath(path)), 'history'),
+    historySocket=default.get('HistorySocket', ''),
+    historyRawSamples=_getInt(default, 'HistoryRawSamples', 3600),
+    historyFlushInterval=_getInt(default, 'HistoryFlushInterval', 300),
+    energyIntegration=_getInt(default, 'EnergyIntegration', 0) == 1,
+    powerFilter=powerFilter,
+    powerFilterAlpha=_getFloat(default, 'PowerFilterAlpha', 0.5),
+    powerFilterWindow=_getInt(default, 'PowerFilterWindow', 5),
+    stateDirectory=default.get('StateDirectory', '') or os.path.join(os.path.dirname(os.path.realpath(path)), 'state'),
+    discovery=_getInt(default, 'Discovery', 0) == 1,
+    discoverySubnet=discoverySubnet,
+    statsInterval=_getInt(default, 'StatsInterval', 10),
+    metricsPort=_getInt(default, 'MetricsPort', 0),
+    aggregateWindow=_getInt(default, 'AggregateWindow', 200),
+    aggregateStale=_getFloat(default, 'AggregateStale', 10),
+    recordFile=default.get('RecordFile', ''),
+    devices=devices,
+    aggregates=tuple(meter for meter in meters if meter.sources))
+
+
+class ConfigWatcher:
+  """Watches the mtime of config.ini on a slow GLib timer and calls
+  callback(settings) with the newly loaded settings only when the file
+  actually changed. An invalid file is logged and the old settings stay."""
+  def __init__(self, path, callback, interval=5):
+    self._path = path
+    self._callback = callback
+    self._stamp = self._getStamp()
+    GLib.timeout_add_seconds(interval, self._check)
+
+  def _getStamp(self):
+    try:
+      stat = os.stat(self._path)
+      return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+      return None
+
+  def _check(self):
+    stamp = self._getStamp()
+    if stamp is not None and stamp != self._stamp:
+      self._stamp = stamp
+      try:
+        settings = loadSettings(self._path)
+      except Exception as e:
+        logging.error("Ignoring changed %s: %s", self._path, e)
+      else:
+        logging.info("Reloaded %s", self._path)
+        self._callback(settings)
+
+    # return true, otherwise the timer is removed
+    return True
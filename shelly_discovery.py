@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+# import normal packages
+import http.client
+import ipaddress
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from gi.repository import GLib
+
+# our own packages
+from shelly_snapshot import loadJson, saveJson
+
+
+MDNS_GROUP = '224.0.0.251'
+MDNS_PORT = 5353
+TYPE_A, TYPE_PTR, TYPE_SRV = 1, 12, 33
+HTTP_SERVICE = '_http._tcp.local'
+
+# types of /shelly we serve, and the mDNS host names of their Gen1 firmware
+SHELLY_TYPES = ('SHEM', 'SHEM-3')
+HOSTNAMES = ('shellyem-%s.local', 'shellyem3-%s.local')
+
+# a larger subnet is not probed
+MAX_PROBE_HOSTS = 1024
+
+
+def _encodeName(name):
+  return b''.join(bytes([len(label)]) + label.encode('utf-8') for label in name.rstrip('.').split('.')) + b'\0'
+
+
+def _decodeName(data, offset):
+  """Returns (name, offset after the name), following compression pointers."""
+  labels = []
+  end = None
+  for hop in range(64):
+    length = data[offset]
+    if length & 0xC0 == 0xC0:
+      if end is None:
+        end = offset + 2
+      offset = ((length & 0x3F) << 8) | data[offset + 1]
+      continue
+    offset += 1
+    if length == 0:
+      break
+    labels.append(data[offset:offset + length].decode('utf-8', 'replace'))
+    offset += length
+  return '.'.join(labels), end if end is not None else offset
+
+
+def parseDnsRecords(data):
+  """Returns [(name, type, value)] of all resource records of a DNS message:
+  A -> IP, PTR -> name, SRV -> (port, target), others are skipped."""
+  count, offset = struct.unpack_from('!H', data, 4)[0], 12
+  for question in range(count):
+    name, offset = _decodeName(data, offset)
+    offset += 4
+  records = []
+  for record in range(sum(struct.unpack_from('!HHH', data, 6))):
+    name, offset = _decodeName(data, offset)
+    rtype, rclass, ttl, length = struct.unpack_from('!HHIH', data, offset)
+    offset += 10
+    if rtype == TYPE_A and length == 4:
+      records.append((name, rtype, socket.inet_ntoa(data[offset:offset + 4])))
+    elif rtype == TYPE_PTR:
+      records.append((name, rtype, _decodeName(data, offset)[0]))
+    elif rtype == TYPE_SRV:
+      records.append((name, rtype, (struct.unpack_from('!H', data, offset + 4)[0], _decodeName(data, offset + 6)[0])))
+    offset += length
+  return records
+
+
+def mdnsQuery(questions, timeout=1.0):
+  """Sends one mDNS query with the (name, type) questions from an ephemeral
+  port, so the answers come back unicast, and collects them for timeout
+  seconds. Returns [(name, type, value)] as parseDnsRecords."""
+  query = struct.pack('!HHHHHH', 0, 0, len(questions), 0, 0, 0)
+  for name, qtype in questions:
+    query += _encodeName(name) + struct.pack('!HH', qtype, 0x8001) # class IN, unicast response
+  records = []
+  with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+    try:
+      sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+      sock.sendto(query, (MDNS_GROUP, MDNS_PORT))
+    except OSError as e:
+      logging.debug("Can not send the mDNS query: %s", e) # no route for multicast
+      return records
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+      sock.settimeout(max(0.01, end - time.monotonic()))
+      try:
+        data, address = sock.recvfrom(9000)
+        records += parseDnsRecords(data)
+      except socket.timeout:
+        break
+      except (OSError, struct.error, IndexError):
+        continue # not a DNS message we understand
+  return records
+
+
+def probeShelly(host, timeout=1.0):
+  """Asks http://<host>/shelly (never password protected), returns (mac, type) of a Shelly EM or 3EM, else None."""
+  connection = http.client.HTTPConnection(host, timeout=timeout)
+  try:
+    connection.request('GET', '/shelly')
+    response = connection.getresponse()
+    if response.status != 200:
+      return None
+    info = json.loads(response.read())
+    if info.get('type') in SHELLY_TYPES and info.get('mac'):
+      return (info['mac'].upper(), info['type'])
+  except (OSError, ValueError, http.client.HTTPException):
+    pass
+  finally:
+    connection.close()
+  return None
+
+
+class Discovery:
+  """Finds Shelly EMs on the LAN and remembers them by MAC (the serial on
+  D-Bus) in a registry file, so a Shelly that got a new IP from DHCP is
+  found again.
+
+  resolve() looks at the registry, asks mDNS for the host name of the MAC
+  and finally probes /shelly on every host of the subnet. It runs on its
+  own threads - one resolve at a time and at most `workers` probes in
+  parallel - never on the worker pool of the polls, and the result comes
+  back on the main loop. The registry is written on the executor."""
+  def __init__(self, path, subnet='', workers=16, timeout=1.0, executor=None):
+    self._path = path
+    self._executor = executor
+    self._subnet = subnet
+    self._timeout = timeout
+    self._registry = loadJson(path) # mac -> {'host', 'type', 'seen'}
+    self._lock = threading.Lock()
+    self._pending = set()
+    self._jobs = ThreadPoolExecutor(max_workers=1)
+    self._probes = ThreadPoolExecutor(max_workers=workers)
+
+  def host(self, mac):
+    with self._lock:
+      return self._registry.get(mac, {}).get('host')
+
+  def remember(self, mac, host, kind=None):
+    with self._lock:
+      entry = self._registry.get(mac, {})
+      changed = entry.get('host') != host or (kind and entry.get('type') != kind)
+      self._registry[mac] = {'host': host, 'type': kind or entry.get('type'), 'seen': time.time()}
+      if not changed or not self._path:
+        return
+      registry = dict(self._registry) # copied here, it changes with the next call
+    if self._executor is not None:
+      self._executor.submit(saveJson, self._path, registry)
+    else:
+      saveJson(self._path, registry)
+
+  def resolve(self, mac, host, callback):
+    """Looks for the Shelly with the MAC, calls callback(host or None) on the main loop; host is the one that failed."""
+    with self._lock:
+      if mac in self._pending:
+        return
+      self._pending.add(mac)
+    self._jobs.submit(self._resolve, mac, host, callback)
+
+  def _resolve(self, mac, failed, callback):
+    found = None
+    try:
+      found = self._find(mac, failed)
+      if found is not None:
+        self.remember(mac, found[0], found[1])
+    except Exception as e:
+      logging.warning("Discovery of Shelly EM %s failed: %s", mac, e)
+    with self._lock:
+      self._pending.discard(mac)
+    GLib.idle_add(self._deliver, callback, found[0] if found else None)
+
+  def _deliver(self, callback, host):
+    callback(host)
+    return False
+
+  def _find(self, mac, failed):
+    # the last known host, if it is not the one that just failed
+    known = self.host(mac)
+    if known and known != failed:
+      info = probeShelly(known, self._timeout)
+      if info and info[0] == mac:
+        return (known, info[1])
+
+    # the Gen1 firmware announces shellyem-<last 6 digits of the MAC>.local
+    questions = [(hostname % (mac[-6:]), TYPE_A) for hostname in HOSTNAMES]
+    for name, rtype, address in mdnsQuery(questions, self._timeout):
+      if rtype == TYPE_A:
+        info = probeShelly(address, self._timeout)
+        if info and info[0] == mac:
+          return (address, info[1])
+
+    # last resort, ask every host of the subnet
+    for host, info in self.probeSubnet(self._getSubnet(failed or known)):
+      if info[0] == mac:
+        return (host, info[1])
+    return None
+
+  def _getSubnet(self, host):
+    if self._subnet:
+      return self._subnet
+    try:
+      return str(ipaddress.ip_network('%s/24' % (host.split(':')[0]), strict=False))
+    except (ValueError, AttributeError):
+      return None
+
+  def probeSubnet(self, subnet):
+    """Yields (host, (mac, type)) of every Shelly EM found in the subnet (CIDR), as they answer."""
+    if not subnet:
+      return
+    network = ipaddress.ip_network(subnet, strict=False)
+    if network.num_addresses > MAX_PROBE_HOSTS:
+      logging.warning("Subnet %s is too large to probe for Shelly EMs", subnet)
+      return
+    futures = dict((self._probes.submit(probeShelly, str(host), self._timeout), str(host)) for host in network.hosts())
+    try:
+      for future in as_completed(futures):
+        info = future.result()
+        if info is not None:
+          yield futures[future], info
+    finally:
+      # the caller found what it was looking for, drop the probes not started yet
+      for future in futures:
+        future.cancel()
+
+  def browse(self):
+    """Returns [(host, mac, type)] of the Shelly EMs announcing _http._tcp on mDNS."""
+    records = mdnsQuery([(HTTP_SERVICE, TYPE_PTR)], self._timeout * 2)
+    addresses = dict((name, value) for name, rtype, value in records if rtype == TYPE_A)
+    targets = set(name for name in addresses if name.startswith('shellyem'))
+    for name, rtype, value in records:
+      if rtype == TYPE_PTR and value.startswith('shellyem'):
+        targets.add(value.split('.')[0] + '.local') # the instance is named like the host
+      elif rtype == TYPE_SRV and name.startswith('shellyem'):
+        targets.add(value[1])
+
+    # host names without an address in the answers
+    missing = [(target, TYPE_A) for target in targets if target not in addresses]
+    if missing:
+      addresses.update((name, value) for name, rtype, value in mdnsQuery(missing, self._timeout) if rtype == TYPE_A)
+
+    found = {}
+    for target in targets:
+      info = probeShelly(addresses[target], self._timeout) if target in addresses else None
+      if info:
+        found[info[0]] = (addresses[target], info[0], info[1])
+    return sorted(found.values())
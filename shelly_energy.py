@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# import normal packages
+import logging
+from collections import deque
+
+# our own packages
+from shelly_fieldmap import PHASE_FIELDS
+from shelly_snapshot import loadJson, saveJson
+
+
+FILTERS = ('none', 'ewma', 'median')
+
+# samples further apart are not integrated, the counters of the Shelly cover the gap
+MAX_GAP = 10 # seconds
+
+# kWh the integrated energy may run ahead of the counter before the first counter step
+AHEAD = 0.01
+
+# seconds between writes of the counters and offsets, resets are written at once
+PERSIST_INTERVAL = 300
+
+FORWARD, REVERSE = range(2)
+
+
+class PowerFilter:
+  """EWMA (alpha = weight of the newest sample) or median of the last window samples."""
+  def __init__(self, kind, alpha=0.5, window=5):
+    self._kind = kind
+    self._alpha = alpha
+    self._value = None
+    self._window = deque(maxlen=window)
+
+  def add(self, value):
+    if self._kind == 'ewma':
+      self._value = value if self._value is None else self._alpha * value + (1 - self._alpha) * self._value
+      return self._value
+    self._window.append(value)
+    return sorted(self._window)[len(self._window) // 2]
+
+
+class PhaseEnergy:
+  """Energy of one phase: the counters of the Shelly plus an offset for
+  every reset of the Shelly, plus the energy integrated from the power
+  since the counter last moved, so the published energy rises smoothly
+  and never goes backwards."""
+  def __init__(self, offset=(0, 0), counter=(None, None)):
+    self.offset = list(offset)
+    self.counter = list(counter)
+    self.pending = [0.0, 0.0] # kWh integrated, not yet in the counter
+    self.ahead = [AHEAD, AHEAD] # kWh pending may reach, the size of the last counter step
+    self._time = None
+    self._power = 0
+
+  def integrate(self, timestamp, power):
+    """Trapezoid of the power between the previous and this sample, split at a zero crossing."""
+    if self._time is not None and 0 < timestamp - self._time <= MAX_GAP:
+      p0, p1, dt = self._power, power, timestamp - self._time
+      if p0 >= 0 and p1 >= 0:
+        forward, reverse = (p0 + p1) / 2 * dt, 0
+      elif p0 <= 0 and p1 <= 0:
+        forward, reverse = 0, -(p0 + p1) / 2 * dt
+      else:
+        crossing = p0 / (p0 - p1) * dt
+        first, second = p0 / 2 * crossing, p1 / 2 * (dt - crossing)
+        forward, reverse = (first, -second) if p0 > 0 else (second, -first)
+
+      # Ws -> kWh, held while we are ahead of the counter by more than one counter step
+      for direction, energy in ((FORWARD, forward), (REVERSE, reverse)):
+        if energy > 0 and self.pending[direction] < self.ahead[direction]:
+          self.pending[direction] += energy / 3600000
+    self._time, self._power = timestamp, power
+
+  def update(self, direction, counter):
+    """Takes the counter (kWh) of the Shelly, returns the energy to publish and whether the Shelly was reset."""
+    last = self.counter[direction]
+    reset = False
+    if last is None:
+      self.counter[direction] = counter
+    elif counter < last:
+      # the Shelly restarted from 0, continue from what we published last
+      self.offset[direction] += last + self.pending[direction] - counter
+      self.pending[direction] = 0.0
+      self.counter[direction] = counter
+      reset = True
+    elif counter > last:
+      step = counter - last
+      self.pending[direction] = max(0.0, self.pending[direction] - step)
+      self.ahead[direction] = max(step, 0.001)
+      self.counter[direction] = counter
+    return self.offset[direction] + counter + self.pending[direction], reset
+
+
+class EnergyIntegrator:
+  """Energy and power of one meter: integrates the power between the
+  counter updates of the Shelly, compensates resets of its counters and
+  optionally filters the published power. The offsets are kept in a small
+  JSON file (written on the executor), so a reset of the Shelly while the
+  service was stopped is compensated, too. O(phases) per sample, the
+  median filter O(window)."""
+  def __init__(self, name, phases, path, powerFilter='none', alpha=0.5, window=5, executor=None):
+    self._name = name
+    self._path = path
+    self._executor = executor
+    self._saved = 0
+    state = loadJson(path)
+
+    # the paths of every phase, formatted once
+    self._phases = []
+    for channel, phase in phases:
+      paths = dict((field, template % (phase)) for field, template, scale in PHASE_FIELDS)
+      stored = state.get(phase, {})
+      self._phases.append((
+        PhaseEnergy(stored.get('offset', (0, 0)), stored.get('counter', (None, None))),
+        PowerFilter(powerFilter, alpha, window) if powerFilter != 'none' else None,
+        paths['power'], paths['total'], paths['total_returned'], phase))
+
+  def _save(self, timestamp):
+    # copied here, the lists change with the next sample
+    state = dict((phase, {'offset': list(energy.offset), 'counter': list(energy.counter)}) for energy, powerFilter, power, forward, reverse, phase in self._phases)
+    if self._executor is not None:
+      self._saved = timestamp
+      self._executor.submit(saveJson, self._path, state)
+    elif saveJson(self._path, state):
+      self._saved = timestamp
+
+  def apply(self, timestamp, values):
+    """Replaces energy and power of the phases and totals in values (dict path -> value of FieldMap)."""
+    reset = False
+    power = forward = reverse = 0
+    for energy, powerFilter, powerPath, forwardPath, reversePath, phase in self._phases:
+      energy.integrate(timestamp, values[powerPath])
+      values[forwardPath], forwardReset = energy.update(FORWARD, values[forwardPath])
+      values[reversePath], reverseReset = energy.update(REVERSE, values[reversePath])
+      if forwardReset or reverseReset:
+        logging.warning("Energy counter of %s %s went backwards, the Shelly was reset - compensated", self._name, phase)
+        reset = True
+      if powerFilter is not None:
+        values[powerPath] = powerFilter.add(values[powerPath])
+      power += values[powerPath]
+      forward += values[forwardPath]
+      reverse += values[reversePath]
+
+    values['/Ac/Power'] = power
+    values['/Ac/Energy/Forward'] = forward
+    values['/Ac/Energy/Reverse'] = reverse
+
+    if reset or timestamp - self._saved >= PERSIST_INTERVAL:
+      self._save(timestamp)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+PHASES = ('L1', 'L2', 'L3')
+
+# field of /emeter/<i> -> D-Bus path of the phase, scale
+PHASE_FIELDS = (
+  ('voltage', '/Ac/%s/Voltage', 1),
+  ('power', '/Ac/%s/Power', 1),
+  ('total', '/Ac/%s/Energy/Forward', 0.001),        # Wh -> kWh
+  ('total_returned', '/Ac/%s/Energy/Reverse', 0.001), # Wh -> kWh
+)
+
+# derived per phase: path <- current of the Shelly (3EM), or power / voltage (EM)
+PHASE_CURRENT = '/Ac/%s/Current'
+
+# derived for the meter: sum over its phases
+TOTALS = (
+  ('/Ac/Power', '/Ac/%s/Power'),
+  ('/Ac/Current', '/Ac/%s/Current'),
+  ('/Ac/Energy/Forward', '/Ac/%s/Energy/Forward'),
+  ('/Ac/Energy/Reverse', '/Ac/%s/Energy/Reverse'),
+)
+
+# operations of the compiled map
+COPY, CURRENT, SUM = range(3)
+
+
+class FieldMap:
+  """Mapping of the clamps of a meter to its D-Bus paths.
+
+  Built once from the phases of the meter ((channel, phase) pairs, e.g.
+  ((1, 'L1'),) for a Shelly EM clamp or ((0, 'L1'), (1, 'L2'), (2, 'L3'))
+  for a Shelly 3EM) and compiled into a flat list of operations on value
+  slots, so a sample is mapped in one loop without building paths or
+  looking up the mapping again."""
+  def __init__(self, phases):
+    paths = []
+    ops = []
+
+    def slot(path):
+      paths.append(path)
+      return len(paths) - 1
+
+    for channel, phase in phases:
+      slots = {}
+      for field, template, scale in PHASE_FIELDS:
+        slots[template] = slot(template % (phase))
+        ops.append((COPY, channel, field, scale, slots[template]))
+      slots[PHASE_CURRENT] = slot(PHASE_CURRENT % (phase))
+      ops.append((CURRENT, channel, slots['/Ac/%s/Power'], slots['/Ac/%s/Voltage'], slots[PHASE_CURRENT]))
+
+    for path, template in TOTALS:
+      parts = tuple(paths.index(template % (phase)) for channel, phase in phases)
+      ops.append((SUM, None, parts, None, slot(path)))
+
+    self.paths = tuple(paths)
+    self.channels = tuple(sorted(set(channel for channel, phase in phases)))
+    self._ops = tuple(ops)
+    self._size = len(paths)
+
+  def values(self, emeters):
+    """Returns the dict path -> value for the emeters of one sample (list indexed by channel)."""
+    out = [0] * self._size
+    for op, channel, a, b, c in self._ops:
+      if op == COPY:
+        out[c] = emeters[channel][a] * b
+      elif op == CURRENT:
+        current = emeters[channel].get('current')
+        if current is None:
+          voltage = out[b]
+          current = out[a] / voltage if voltage else 0 # no voltage on the clamp, no current
+        out[c] = current
+      else:
+        out[c] = sum([out[part] for part in a])
+    return dict(zip(self.paths, out))
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+# import normal packages
+import json
+import logging
+import math
+import os
+import socket
+import struct
+from array import array
+from gi.repository import GLib
+
+# our own packages
+from shelly_snapshot import saveFile
+
+
+# values of a meter kept in the history
+COLUMNS = ('/Ac/Power', '/Ac/Current', '/Ac/Energy/Forward', '/Ac/Energy/Reverse')
+
+# name, seconds per row, rows - 1 hour of seconds, 1 day of minutes, 31 days of 15 minutes
+TIERS = (
+  ('1s', 1, 3600),
+  ('1min', 60, 1440),
+  ('15min', 900, 2976),
+)
+
+MAGIC = b'SEMH'
+VERSION = 1
+HEADER = struct.Struct('<4sIII')  # magic, version, columns, tiers
+TIER_HEADER = struct.Struct('<IIII') # seconds, capacity, head, count
+
+
+class Ring:
+  """Fixed number of rows of doubles in a flat buffer - an array('d') or a
+  memoryview of the buffer of a history file. The oldest row is overwritten."""
+  def __init__(self, buffer, width, capacity, head=0, count=0):
+    self._buffer = buffer
+    self.width = width
+    self.capacity = capacity
+    self.head = head   # next row to write
+    self.count = count
+
+  def append(self, row):
+    start = self.head * self.width
+    self._buffer[start:start + self.width] = array('d', row)
+    self.head = (self.head + 1) % self.capacity
+    self.count = min(self.count + 1, self.capacity)
+
+  def rows(self, since=0):
+    """Rows from the oldest to the newest, only those with time (first value) >= since."""
+    rows = []
+    for index in range(self.head - self.count, self.head):
+      start = (index % self.capacity) * self.width
+      if self._buffer[start] >= since:
+        rows.append(self._buffer[start:start + self.width].tolist())
+    return rows
+
+  def copy(self):
+    """Copy of the rows at this moment, to read them on another thread."""
+    buffer = array('d')
+    buffer.frombytes(memoryview(self._buffer).tobytes())
+    return Ring(buffer, self.width, self.capacity, self.head, self.count)
+
+
+class Tier:
+  """Rolls samples up into rows of time, then min, max, avg of every column."""
+  def __init__(self, name, seconds, ring, onRow=None):
+    self.name = name
+    self.seconds = seconds
+    self.ring = ring
+    self._onRow = onRow
+    self._bucket = None
+    self._columns = (ring.width - 1) // 3
+
+  def add(self, timestamp, values):
+    bucket = timestamp - timestamp % self.seconds
+    if bucket != self._bucket:
+      self._flush()
+      self._bucket = bucket
+      self._count = 0
+      self._sum = [0.0] * self._columns
+      self._min = [math.inf] * self._columns
+      self._max = [-math.inf] * self._columns
+
+    self._count += 1
+    for column, value in enumerate(values):
+      self._sum[column] += value
+      if value < self._min[column]:
+        self._min[column] = value
+      if value > self._max[column]:
+        self._max[column] = value
+
+  def _flush(self):
+    if self._bucket is None or self._count == 0:
+      return
+    row = [self._bucket]
+    for column in range(self._columns):
+      row += [self._min[column], self._max[column], self._sum[column] / self._count]
+    self.ring.append(row)
+    if self._onRow is not None:
+      self._onRow(self)
+
+
+class MeterHistory:
+  """Every raw sample of one meter in RAM, rolled up into the TIERS, which
+  are kept in RAM too, in the layout of the history file they are read
+  from at startup. flush() writes the rows added since the last flush and
+  the tier headers in place, never per sample, so they survive a restart;
+  the whole file is only written when it is created."""
+  def __init__(self, name, path, rawSamples):
+    self.name = name
+    self.path = path
+    self._appended = [0] * len(TIERS) # rows added per tier since the last flush
+    width = 1 + len(COLUMNS)
+    self.raw = Ring(array('d', bytes(8 * width * rawSamples)), width, rawSamples)
+
+    width = 1 + 3 * len(COLUMNS)
+    headerSize = HEADER.size + TIER_HEADER.size * len(TIERS)
+    headerSize += -headerSize % 8 # rows aligned to doubles
+    size = headerSize + sum(8 * width * capacity for name, seconds, capacity in TIERS)
+    self._headerSize = headerSize
+
+    self._data = self._readFile(path, size)
+    valid = self._data is not None
+    self._full = not valid # the whole file is written with the next flush
+    if not valid:
+      logging.info("Creating history file %s", path)
+      self._data = bytearray(size)
+      HEADER.pack_into(self._data, 0, MAGIC, VERSION, len(COLUMNS), len(TIERS))
+
+    doubles = memoryview(self._data).cast('d')
+    self.tiers = []
+    self._offsets = [] # byte offset of the rows of every tier in the file
+    offset = headerSize // 8
+    for index, (name, seconds, capacity) in enumerate(TIERS):
+      head = count = 0
+      if valid:
+        storedSeconds, storedCapacity, head, count = TIER_HEADER.unpack_from(self._data, HEADER.size + index * TIER_HEADER.size)
+        if (storedSeconds, storedCapacity) != (seconds, capacity):
+          head = count = 0
+      ring = Ring(doubles[offset:offset + width * capacity], width, capacity, head, count)
+      self.tiers.append(Tier(name, seconds, ring, self._storeTierHeader))
+      self._offsets.append(offset * 8)
+      offset += width * capacity
+
+  def _readFile(self, path, size):
+    # the content of a history file of this layout, or None
+    try:
+      with open(path, 'rb') as f:
+        data = bytearray(f.read(size + 1))
+    except FileNotFoundError:
+      return None
+    except OSError as e:
+      logging.warning("Can not read %s: %s", path, e)
+      return None
+    if len(data) != size or HEADER.unpack_from(data) != (MAGIC, VERSION, len(COLUMNS), len(TIERS)):
+      return None
+    return data
+
+  def _storeTierHeader(self, tier):
+    index = self.tiers.index(tier)
+    TIER_HEADER.pack_into(self._data, HEADER.size + index * TIER_HEADER.size, tier.seconds, tier.ring.capacity, tier.ring.head, tier.ring.count)
+    self._appended[index] += 1
+
+  def add(self, timestamp, values):
+    row = [values.get(column, math.nan) for column in COLUMNS]
+    self.raw.append([timestamp] + row)
+    for tier in self.tiers:
+      tier.add(timestamp, row)
+
+  def select(self, tier='raw'):
+    """Returns (columns, copy of the rows of the tier), to be queried on another thread."""
+    if tier == 'raw':
+      return ('time',) + COLUMNS, self.raw.copy()
+    for candidate in self.tiers:
+      if candidate.name == tier:
+        return ('time',) + tuple('%s:%s' % (column, kind) for column in COLUMNS for kind in ('min', 'max', 'avg')), candidate.ring.copy()
+    raise ValueError("Unknown tier %s" % (tier))
+
+  def flush(self, executor):
+    """Copies what changed since the last flush and writes it on the executor."""
+    if self._full:
+      self._full = False
+      self._appended = [0] * len(TIERS)
+      executor.submit(self._writeFile, bytes(self._data))
+      return
+    if not any(self._appended):
+      return
+
+    chunks = [] # (offset in the file, bytes)
+    for index, tier in enumerate(self.tiers):
+      ring, rowSize = tier.ring, 8 * tier.ring.width
+      appended = min(self._appended[index], ring.capacity)
+      start = (ring.head - appended) % ring.capacity
+      # the new rows up to the end of the ring, then those that wrapped around to its start
+      for first, rows in ((start, min(appended, ring.capacity - start)), (0, appended - (ring.capacity - start))):
+        if rows > 0:
+          offset = self._offsets[index] + first * rowSize
+          chunks.append((offset, bytes(self._data[offset:offset + rows * rowSize])))
+    # the headers last, they only point to rows already written
+    chunks.append((0, bytes(self._data[:self._headerSize])))
+    self._appended = [0] * len(TIERS)
+    executor.submit(self._writeRows, chunks)
+
+  def _writeFile(self, data):
+    # on the executor
+    if not saveFile(self.path, data):
+      self._full = True
+
+  def _writeRows(self, chunks):
+    # on the executor, only the changed bytes - a few KB instead of the whole file
+    try:
+      fd = os.open(self.path, os.O_WRONLY)
+      try:
+        for offset, data in chunks:
+          os.pwrite(fd, data, offset)
+      finally:
+        os.close(fd)
+    except OSError as e:
+      logging.warning("Can not write %s: %s", self.path, e)
+      self._full = True
+
+
+class History:
+  """The histories of all meters, written to flash every flushInterval
+  seconds and queried over a UNIX socket: one JSON request per line, e.g.
+  {"meter": "grid", "tier": "1min", "since": 1700000000}, answered with one
+  JSON line. Tiers are raw, 1s, 1min and 15min. The files are written and
+  the answers built on the executor, the main loop only copies the rows."""
+  def __init__(self, directory, socketPath, executor, rawSamples=3600, flushInterval=300):
+    self._directory = directory
+    self._executor = executor
+    self._rawSamples = rawSamples
+    self._meters = {}
+    os.makedirs(directory, exist_ok=True)
+    GLib.timeout_add_seconds(flushInterval, self._flush)
+    if socketPath:
+      self._listen(socketPath)
+
+  def meter(self, name):
+    if name not in self._meters:
+      self._meters[name] = MeterHistory(name, os.path.join(self._directory, '%s.history' % (name)), self._rawSamples)
+    return self._meters[name]
+
+  def _flush(self):
+    for meter in self._meters.values():
+      meter.flush(self._executor)
+    return True
+
+  def _listen(self, path):
+    if os.path.exists(path):
+      os.unlink(path)
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._socket.bind(path)
+    self._socket.listen(4)
+    self._socket.setblocking(False)
+    GLib.io_add_watch(self._socket.fileno(), GLib.IO_IN, self._accept)
+
+  def _accept(self, fd, condition):
+    try:
+      client, address = self._socket.accept()
+      client.setblocking(False)
+      request = bytearray()
+      GLib.io_add_watch(client.fileno(), GLib.IO_IN | GLib.IO_HUP, self._read, client, request)
+    except OSError as e:
+      logging.debug("History socket accept failed: %s", e)
+    return True
+
+  def _read(self, fd, condition, client, request):
+    try:
+      data = client.recv(4096)
+    except BlockingIOError:
+      return True
+    except OSError:
+      data = b''
+    request += data
+    if data and b'\n' not in request and len(request) < 4096:
+      return True # wait for the rest of the line
+
+    if not request.strip():
+      client.close()
+      return False
+
+    try:
+      query = json.loads(bytes(request).split(b'\n')[0].decode('utf-8'))
+      meter = self._meters.get(query.get('meter'))
+      if meter is None:
+        raise ValueError("Unknown meter %s, known are %s" % (query.get('meter'), ', '.join(sorted(self._meters))))
+      columns, ring = meter.select(query.get('tier', 'raw'))
+      self._executor.submit(self._answer, client, columns, ring, float(query.get('since', 0)))
+    except Exception as e:
+      self._respond(client, json.dumps({'error': str(e)}).encode('utf-8'))
+    return False
+
+  def _answer(self, client, columns, ring, since):
+    # on the executor, up to thousands of rows
+    try:
+      response = json.dumps({'columns': columns, 'rows': ring.rows(since)}).encode('utf-8')
+    except Exception as e:
+      response = json.dumps({'error': str(e)}).encode('utf-8')
+    GLib.idle_add(self._respond, client, response)
+
+  def _respond(self, client, response):
+    # written in chunks whenever the socket can take more, the main loop never waits for the client
+    GLib.io_add_watch(client.fileno(), GLib.IO_OUT | GLib.IO_HUP | GLib.IO_ERR, self._write, client, [memoryview(response + b'\n')])
+    return False
+
+  def _write(self, fd, condition, client, response):
+    try:
+      sent = client.send(response[0])
+      response[0] = response[0][sent:]
+      if len(response[0]) > 0 and not condition & (GLib.IO_HUP | GLib.IO_ERR):
+        return True
+    except BlockingIOError:
+      return True
+    except OSError:
+      pass
+    client.close()
+    return False
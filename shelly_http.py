@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+# import normal packages
+import base64
+import http.client
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from gi.repository import GLib
+
+
+HTTP_CLIENTS = ('requests', 'stdlib')
+
+
+class HttpStatusError(ConnectionError):
+  """The Shelly answered, with an HTTP error status."""
+
+
+def isTimeout(error):
+  requests = sys.modules.get('requests') # only loaded with HttpClient=requests
+  return isinstance(error, socket.timeout) or (requests is not None and isinstance(error, requests.exceptions.Timeout))
+
+
+def basicAuthHeader(username, password):
+  # encoded once when the client is created, not for every request
+  credentials = ("%s:%s" % (username, password)).encode('latin1')
+  return 'Basic ' + base64.b64encode(credentials).decode('ascii')
+
+
+def decodeResponse(baseUrl, path, status, body):
+  # check for response
+  if not 200 <= status < 400:
+      raise HttpStatusError("No response from Shelly EM - %s%s (HTTP %s)" % (baseUrl, path, status))
+  
+  data = json.loads(body)
+  
+  # check for Json
+  if not data:
+      raise ValueError("Converting response to JSON failed")
+  
+  return data
+
+
+class ShellyHttpClient:
+  """Long-lived keep-alive HTTP connection to one Shelly.
+
+  The single pooled connection is reused for every request, urllib3 opens
+  a fresh one if the Shelly dropped the idle socket. Only a failed connect
+  is retried once, a read timeout is not - it stays a timeout of
+  ReadTimeout seconds. A lock keeps requests of two worker threads (poll and
+  reading the serial) from opening a second connection the pool discards."""
+  def __init__(self, baseUrl, username='', password='', timeout=(2, 2), stats=None, recorder=None):
+    import requests # for http GET, only imported when used
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    self._baseUrl = baseUrl
+    self._timeout = timeout
+    self._stats = stats # Stats recording round trip and decode time, or None
+    self._recorder = recorder # record(path, started, latency, status, body, error) of every response, or None
+    self._lock = threading.Lock()
+    
+    self._session = requests.Session()
+    self._session.headers['Connection'] = 'keep-alive'
+    if username or password:
+      self._session.headers['Authorization'] = basicAuthHeader(username, password)
+    
+    # the Shelly serves only a few connections, one is all we need
+    self._session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1,
+                                                   max_retries=Retry(total=1, connect=1, read=False, status=0)))
+
+  def getJson(self, path):
+    wallclock, started = time.time(), time.perf_counter()
+    try:
+      with self._lock:
+        response = self._session.get(self._baseUrl + path, timeout=self._timeout)
+    except Exception as e:
+      if self._recorder is not None:
+        self._recorder(path, wallclock, time.perf_counter() - started, error=e)
+      raise
+    received = time.perf_counter()
+    if self._recorder is not None:
+      self._recorder(path, wallclock, received - started, response.status_code, response.content)
+    
+    data = decodeResponse(self._baseUrl, path, response.status_code, response.content)
+    if self._stats is not None:
+      self._stats.record('rtt', received - started)
+      self._stats.record('decode', time.perf_counter() - received)
+    return data
+
+  def connectionStats(self):
+    """Returns (new, reused) - connections opened and requests served on an already open connection."""
+    pools = self._session.get_adapter(self._baseUrl).poolmanager.pools
+    connections = served = 0
+    for key in pools.keys():
+      pool = pools[key]
+      connections += pool.num_connections
+      served += pool.num_requests
+    return (connections, served - connections)
+
+  def close(self):
+    self._session.close()
+
+
+class StdlibHttpClient:
+  """ShellyHttpClient on http.client of the standard library, without
+  requests, urllib3 and their dependencies - less import time and memory.
+
+  One keep-alive connection, and if the Shelly dropped the idle socket the
+  request is retried once on a fresh connection. A lock keeps requests of
+  two worker threads (poll and discovery) from interleaving on it."""
+  def __init__(self, baseUrl, username='', password='', timeout=(2, 2), stats=None, recorder=None):
+    self._baseUrl = baseUrl
+    url = urlsplit(baseUrl)
+    self._host, self._port = url.hostname, url.port
+    self._timeout = timeout
+    self._stats = stats
+    self._recorder = recorder
+    self._headers = {'Connection': 'keep-alive', 'Accept': 'application/json'}
+    if username or password:
+      self._headers['Authorization'] = basicAuthHeader(username, password)
+    self._lock = threading.Lock()
+    self._connection = None
+    self._connections = 0
+    self._requests = 0
+
+  def _connect(self):
+    connection = http.client.HTTPConnection(self._host, self._port, timeout=self._timeout[0])
+    connection.connect()
+    connection.sock.settimeout(self._timeout[1])
+    self._connections += 1
+    return connection
+
+  def _get(self, path):
+    reused = self._connection is not None
+    if not reused:
+      self._connection = self._connect()
+    try:
+      self._connection.request('GET', path, headers=self._headers)
+      response = self._connection.getresponse()
+      body = response.read()
+    except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError, BrokenPipeError):
+      self._close()
+      if not reused:
+        raise
+      # the Shelly closed the idle connection
+      return self._get(path)
+    except Exception:
+      self._close()
+      raise
+    
+    self._requests += 1
+    if response.will_close:
+      self._close()
+    return response, body
+
+  def getJson(self, path):
+    wallclock, started = time.time(), time.perf_counter()
+    try:
+      with self._lock:
+        response, body = self._get(path)
+    except Exception as e:
+      if self._recorder is not None:
+        self._recorder(path, wallclock, time.perf_counter() - started, error=e)
+      raise
+    received = time.perf_counter()
+    if self._recorder is not None:
+      self._recorder(path, wallclock, received - started, response.status, body)
+    
+    data = decodeResponse(self._baseUrl, path, response.status, body)
+    if self._stats is not None:
+      self._stats.record('rtt', received - started)
+      self._stats.record('decode', time.perf_counter() - received)
+    return data
+
+  def connectionStats(self):
+    """Returns (new, reused) - connections opened and requests served on an already open connection."""
+    return (self._connections, self._requests - self._connections)
+
+  def _close(self):
+    if self._connection is not None:
+      self._connection.close()
+      self._connection = None
+
+  def close(self):
+    with self._lock:
+      self._close()
+
+
+def createHttpClient(kind, baseUrl, username='', password='', timeout=(2, 2), stats=None, recorder=None):
+  """kind is one of HTTP_CLIENTS."""
+  client = StdlibHttpClient if kind == 'stdlib' else ShellyHttpClient
+  return client(baseUrl, username, password, timeout, stats, recorder)
+
+
+class AsyncFetcher:
+  """Runs a blocking fetch function on a worker thread, so the GLib main loop
+  never waits on the network. The result is handed back to the main loop
+  with GLib.idle_add, and if several results complete before the main loop
+  gets to them only the newest one is delivered."""
+  def __init__(self, fetch, callback, executor=None):
+    self._fetch = fetch
+    self._callback = callback
+    self._executor = executor or ThreadPoolExecutor(max_workers=1)
+    self._lock = threading.Lock()
+    self._inflight = False
+    self._sequence = 0
+    self._result = None # newest completed (sequence, started, data, error) not yet delivered
+    self._deliverScheduled = False
+
+  def busy(self):
+    with self._lock:
+      return self._inflight
+
+  def request(self):
+    """Starts a fetch on the worker, returns False if the previous one is still running."""
+    with self._lock:
+      if self._inflight:
+        return False
+      self._inflight = True
+      self._sequence += 1
+      sequence = self._sequence
+    self._executor.submit(self._run, sequence)
+    return True
+
+  def _run(self, sequence):
+    started = time.time()
+    try:
+      data, error = self._fetch(), None
+    except Exception as e:
+      data, error = None, e
+
+    with self._lock:
+      self._inflight = False
+      if self._result is None or self._result[0] < sequence:
+        self._result = (sequence, started, data, error)
+      schedule = not self._deliverScheduled
+      self._deliverScheduled = True
+
+    if schedule:
+      GLib.idle_add(self._deliver)
+
+  def _deliver(self):
+    with self._lock:
+      result, self._result = self._result, None
+      self._deliverScheduled = False
+
+    if result is not None:
+      sequence, started, data, error = result
+      try:
+        self._callback(data, error, started)
+      except Exception as e:
+        logging.critical('Error at %s', '_deliver', exc_info=e)
+
+    # run once, return False to remove the idle source again
+    return False
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# import normal packages
+import atexit
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+# current.log is rotated at this size, keeping BACKUPS old files
+MAX_BYTES = 1024 * 1024
+BACKUPS = 2
+
+# seconds a message of the same kind is shown only once
+SIMILAR_WINDOW = 60
+
+
+class LocalQueueHandler(QueueHandler):
+  """Puts the record on the queue as it is: the listener is in the same
+  process, so message and traceback are formatted on its thread and not on
+  the main loop."""
+  def prepare(self, record):
+    return record
+
+
+class SimilarFilter(logging.Filter):
+  """Passes the first WARNING or worse of a kind (logger, level, message
+  with its arguments, type of the exception) per window and counts the
+  others, so the same error of another Shelly or code path is shown. When
+  the window is over, the count is logged once as "suppressed N
+  similar messages". Called on the logging thread, which may be a worker."""
+  def __init__(self, handler, window=SIMILAR_WINDOW, level=logging.WARNING):
+    logging.Filter.__init__(self)
+    self._handler = handler
+    self._window = window
+    self._level = level
+    self._lock = threading.Lock()
+    self._seen = {}     # key -> [end of the window, suppressed, first record]
+    self._nextCheck = 0
+
+  def filter(self, record):
+    if getattr(record, 'suppressedSummary', False):
+      return True
+
+    summaries = []
+    with self._lock:
+      if record.created >= self._nextCheck:
+        summaries = self._getExpired(record.created)
+        self._nextCheck = record.created + 1
+
+      passed = True
+      if record.levelno >= self._level:
+        key = (record.name, record.levelno, record.getMessage(), record.exc_info[0] if record.exc_info else None)
+        entry = self._seen.get(key)
+        if entry is None:
+          self._seen[key] = [record.created + self._window, 0, record]
+        else:
+          entry[1] += 1
+          passed = False
+
+    for summary in summaries:
+      self._handler.handle(summary)
+    return passed
+
+  def _getExpired(self, now):
+    summaries = []
+    for key, (end, suppressed, record) in list(self._seen.items()):
+      if end > now:
+        continue
+      del self._seen[key]
+      if suppressed:
+        summary = logging.LogRecord(record.name, record.levelno, record.pathname, record.lineno,
+                                    "Suppressed %d similar messages in %d s: %s", (suppressed, self._window, record.getMessage()), None)
+        summary.suppressedSummary = True
+        summaries.append(summary)
+    return summaries
+
+
+def setupLogging(logfile, level=logging.INFO, format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'):
+  """Logs through a queue: the callers only enqueue, a thread writes the
+  size-rotated logfile and stderr, so the main loop never waits on the disk."""
+  formatter = logging.Formatter(format, datefmt)
+  handlers = [RotatingFileHandler(logfile, maxBytes=MAX_BYTES, backupCount=BACKUPS), logging.StreamHandler()]
+  for handler in handlers:
+    handler.setFormatter(formatter)
+
+  logqueue = queue.SimpleQueue()
+  listener = QueueListener(logqueue, *handlers)
+  listener.start()
+  atexit.register(listener.stop) # writes what is still queued
+
+  handler = LocalQueueHandler(logqueue)
+  handler.addFilter(SimilarFilter(handler))
+  root = logging.getLogger()
+  root.setLevel(level)
+  root.addHandler(handler)
+  return listener
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# import normal packages
+import fnmatch
+import time
+
+
+class DbusPublisher:
+  """Sends new values to a VeDbusService only if they moved beyond the
+  deadband of their path since they were last published.
+
+  All changes of one sample go out together, as a single ItemsChanged
+  signal on velib versions that support `with service as ctx:` and as
+  single item writes otherwise. /UpdateIndex is only bumped when something
+  was sent, and at least every `heartbeat` seconds all values are sent
+  again so stale detection keeps working while the load is steady."""
+  def __init__(self, dbusservice, deadbands=(), heartbeat=10):
+    self._dbusservice = dbusservice
+    self._batched = hasattr(dbusservice, '__enter__')
+    self._published = {}
+    self._lastPublish = 0
+    self.configure(deadbands, heartbeat)
+
+  def configure(self, deadbands, heartbeat):
+    """deadbands is a sequence of (pattern, absolute, relative), first matching pattern wins."""
+    self._deadbandPatterns = tuple(deadbands)
+    self._deadbands = {} # path -> (absolute, relative), resolved on first use
+    self._heartbeat = heartbeat
+
+  def _getDeadband(self, path):
+    deadband = self._deadbands.get(path)
+    if deadband is None:
+      deadband = (0, 0)
+      for pattern, absolute, relative in self._deadbandPatterns:
+        if fnmatch.fnmatchcase(path, pattern):
+          deadband = (absolute, relative)
+          break
+      self._deadbands[path] = deadband
+    return deadband
+
+  def _isChanged(self, path, value):
+    if path not in self._published:
+      return True
+    last = self._published[path]
+    if not isinstance(value, (int, float)) or not isinstance(last, (int, float)):
+      return value != last
+
+    absolute, relative = self._getDeadband(path)
+    return abs(value - last) > max(absolute, abs(last) * relative)
+
+  def publish(self, values, now=None, updateIndex=True):
+    """Publishes the changed values of the dict path -> value, returns the number of paths sent."""
+    now = now if now is not None else time.time()
+    heartbeat = now - self._lastPublish >= self._heartbeat
+
+    changes = {}
+    for path, value in values.items():
+      if heartbeat or self._isChanged(path, value):
+        changes[path] = value
+    if not changes:
+      return 0
+
+    # increment UpdateIndex - to show that new data is available
+    if updateIndex:
+      changes['/UpdateIndex'] = (self._dbusservice['/UpdateIndex'] + 1) % 256 # overflow from 255 to 0
+
+    if self._batched:
+      with self._dbusservice as service:
+        for path, value in changes.items():
+          service[path] = value
+    else:
+      for path, value in changes.items():
+        self._dbusservice[path] = value
+
+    self._published.update(changes)
+    self._lastPublish = now
+    return len(changes)
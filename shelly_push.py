@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+# import normal packages
+import json
+import logging
+import socket
+import struct
+import threading
+from gi.repository import GLib
+
+
+COIOT_GROUP = '224.0.1.187'
+COIOT_PORT = 5683
+COIOT_OPTION_DEVICE = 3332 # "<type>#<mac>#<version>", e.g. SHEM#84CCA8B15999#2
+
+# CoIoT sensor ids of the Shelly EM (SHEM), used if /cit/d can not be read
+SHEM_SENSORS = {
+  4105: (0, 'power'), 4106: (0, 'total'), 4107: (0, 'total_returned'), 4108: (0, 'voltage'),
+  4205: (1, 'power'), 4206: (1, 'total'), 4207: (1, 'total_returned'), 4208: (1, 'voltage'),
+}
+
+# description of a sensor in /cit/d -> field of /emeter/<i>
+COIOT_FIELDS = {
+  'power': 'power',
+  'energy': 'total',
+  'returnedEnergy': 'total_returned',
+  'voltage': 'voltage',
+}
+
+EMETER_FIELDS = ('power', 'voltage', 'total', 'total_returned')
+
+
+def coiotSensorMap(description):
+  """Builds sensor id -> (channel, field) from the /cit/d document of a Shelly."""
+  channels = {}
+  for block in description.get('blk', []):
+    name = block.get('D', '')
+    if name.startswith('emeter_'):
+      channels[block['I']] = int(name[len('emeter_'):])
+
+  sensors = {}
+  for sensor in description.get('sen', []):
+    field = COIOT_FIELDS.get(sensor.get('D'))
+    links = sensor.get('L')
+    for link in links if isinstance(links, list) else [links]:
+      if field and link in channels:
+        sensors[sensor['I']] = (channels[link], field)
+  return sensors
+
+
+def parseCoiotFrame(data):
+  """Returns (device id, payload) of a CoIoT (CoAP over UDP) frame, or None if it is not one."""
+  if len(data) < 4 or data[0] >> 6 != 1:
+    return None
+
+  position = 4 + (data[0] & 0x0F) # header and token
+  option = 0
+  deviceId = None
+  try:
+    while position < len(data) and data[position] != 0xFF:
+      delta, length = data[position] >> 4, data[position] & 0x0F
+      position += 1
+      values = []
+      for nibble in (delta, length):
+        if nibble == 13:
+          nibble = data[position] + 13
+          position += 1
+        elif nibble == 14:
+          nibble = (data[position] << 8 | data[position + 1]) + 269
+          position += 2
+        values.append(nibble)
+      delta, length = values
+      option += delta
+      if option == COIOT_OPTION_DEVICE:
+        deviceId = data[position:position + length].decode('ascii', 'replace')
+      position += length
+    payload = json.loads(data[position + 1:].decode('utf-8')) if position < len(data) else None
+  except (IndexError, ValueError):
+    return None
+
+  return deviceId, payload
+
+
+def emetersFromValues(values, channels):
+  """{channel: {field: value}} -> meter_data like /status, None if a needed value is missing."""
+  emeters = [None] * (channels[-1] + 1)
+  for channel in channels:
+    emeter = values.get(channel, {})
+    if any(field not in emeter for field in EMETER_FIELDS):
+      return None
+    emeters[channel] = dict(emeter)
+  return {'emeters': emeters}
+
+
+class CoiotListener:
+  """Receives the CoIoT status frames all Shellys send to the multicast
+  group, on one UDP socket watched by the GLib main loop, and hands them to
+  the callback subscribed for the MAC of the sender."""
+  def __init__(self, port=COIOT_PORT):
+    self._subscribers = {}
+    self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._socket.bind(('', port))
+    try:
+      membership = struct.pack('4s4s', socket.inet_aton(COIOT_GROUP), socket.inet_aton('0.0.0.0'))
+      self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    except OSError as e:
+      logging.warning("Can not join CoIoT multicast group %s, only unicast frames are received: %s", COIOT_GROUP, e)
+    self._socket.setblocking(False)
+    GLib.io_add_watch(self._socket.fileno(), GLib.IO_IN, self._receive)
+
+  def subscribe(self, mac, callback):
+    """callback(payload) is called with the JSON payload of every frame of this MAC."""
+    self._subscribers[mac.upper()] = callback
+
+  def _receive(self, fd, condition):
+    try:
+      while True:
+        data, address = self._socket.recvfrom(2048)
+        frame = parseCoiotFrame(data)
+        if frame is None or frame[0] is None or frame[1] is None:
+          continue
+        parts = frame[0].split('#')
+        callback = self._subscribers.get(parts[1].upper()) if len(parts) > 1 else None
+        if callback is not None:
+          callback(frame[1])
+    except BlockingIOError:
+      pass
+    except Exception as e:
+      logging.critical('Error at %s', '_receive', exc_info=e)
+
+    # return true, otherwise the watch is removed
+    return True
+
+
+class MqttListener:
+  """Subscribes to the emeter topics a Shelly publishes on a (local) MQTT
+  broker. A burst of messages is collected for a moment and then handed to
+  callback(meter_data) on the GLib main loop.
+
+  Needs paho-mqtt, which is only imported when MQTT is configured."""
+  def __init__(self, host, port, topic, channels, callback):
+    import paho.mqtt.client as mqtt # optional dependency
+    self._prefix = topic.rstrip('/') + '/emeter/'
+    self._channels = channels
+    self._callback = callback
+    self._lock = threading.Lock()
+    self._values = {}
+    self._flushScheduled = False
+
+    try:
+      self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    except AttributeError:
+      self._client = mqtt.Client() # paho-mqtt < 2.0
+    self._client.on_connect = self._onConnect
+    self._client.on_message = self._onMessage
+    self._client.connect_async(host, port)
+    self._client.loop_start()
+
+  def _onConnect(self, client, userdata, flags, rc):
+    logging.info("Connected to MQTT broker, subscribing %s+/+", self._prefix)
+    client.subscribe(self._prefix + '+/+')
+
+  def _onMessage(self, client, userdata, message):
+    # runs on the paho thread
+    try:
+      channel, field = message.topic[len(self._prefix):].split('/')
+      if field not in EMETER_FIELDS:
+        return
+      value = float(message.payload)
+    except ValueError:
+      return
+
+    with self._lock:
+      self._values.setdefault(int(channel), {})[field] = value
+      schedule = not self._flushScheduled
+      self._flushScheduled = True
+    if schedule:
+      GLib.timeout_add(50, self._flush)
+
+  def _flush(self):
+    with self._lock:
+      meter_data = emetersFromValues(self._values, self._channels)
+      self._flushScheduled = False
+
+    if meter_data is not None:
+      self._callback(meter_data)
+    return False
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# import normal packages
+import atexit
+import collections
+import gzip
+import json
+import logging
+import socket
+import threading
+import time
+import zlib
+
+# our own packages
+from shelly_http import decodeResponse, isTimeout
+
+
+# seconds between flushes of the compressed stream, a crash loses at most this
+FLUSH_INTERVAL = 10
+
+
+class Recorder:
+  """Appends every response of the Shellys - raw body, HTTP status or
+  error, start time and latency - as one JSON line to a gzip file, to
+  replay it later with ReplayClient (tools/replay_recording.py).
+
+  Called on the worker threads. Every start of the service appends a new
+  gzip member, which gzip reads as one stream."""
+  def __init__(self, path):
+    self._path = path
+    self._lock = threading.Lock()
+    self._file = gzip.open(path, 'ab')
+    self._flushed = time.time()
+    atexit.register(self.close)
+    logging.info("Recording the responses of the Shellys to %s", path)
+
+  def forDevice(self, name):
+    """Returns the record function the HTTP client of one Shelly calls."""
+    def record(path, started, latency, status=None, body=None, error=None):
+      self.add(name, path, started, latency, status, body, error)
+    return record
+
+  def add(self, device, path, started, latency, status=None, body=None, error=None):
+    entry = {'device': device, 'time': round(started, 6), 'ms': round(latency * 1000, 3), 'path': path}
+    if error is not None:
+      entry.update({'error': str(error) or type(error).__name__, 'timeout': isTimeout(error)})
+    else:
+      entry.update({'status': status, 'body': body.decode('utf-8', 'replace')})
+    line = (json.dumps(entry, separators=(',', ':')) + '\n').encode('utf-8')
+
+    with self._lock:
+      if self._file is None:
+        return
+      self._file.write(line)
+      if started - self._flushed >= FLUSH_INTERVAL:
+        self._file.flush()
+        self._flushed = started
+
+  def close(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+
+
+def readRecording(path):
+  """Returns the records of a recording, by device name: {device: [record]} in the recorded order."""
+  devices = collections.OrderedDict()
+  with gzip.open(path, 'rt', encoding='utf-8') as f:
+    try:
+      for line in f:
+        record = json.loads(line)
+        devices.setdefault(record['device'], []).append(record)
+    except (EOFError, zlib.error, ValueError) as e:
+      # the service was killed before it flushed, the records before are fine
+      logging.warning("Recording %s ends with an incomplete record: %s", path, e)
+  return devices
+
+
+class ReplayClient:
+  """Stand-in for the HTTP client of one Shelly, answering from a
+  recording instead of the network. Each path gets its recorded responses
+  in order, so /emeter/<i>, /status and /cit/d do not steal each other's.
+  With realtime the answers come at the recorded time and latency
+  (measured from the first call), otherwise at once.
+
+  `started` is the recorded start time of the first response since it was
+  last set to None, the timestamp of the sample for a deterministic replay."""
+  def __init__(self, records, realtime=False, stats=None):
+    self._queues = collections.defaultdict(collections.deque)
+    for record in records:
+      self._queues[record['path']].append(record)
+    self._first = records[0]['time'] if records else 0
+    self._realtime = realtime
+    self._stats = stats
+    self._start = None
+    self._lock = threading.Lock()
+    self.started = None
+    self._misses = 0 # paths asked for after their last response, since the last response given
+
+  def done(self):
+    """True when the recording is used up, or what is left is never asked for."""
+    return self._misses >= 2 or not any(self._queues.values())
+
+  def nextTime(self):
+    """Recorded start time of the next response, None at the end."""
+    times = [queue[0]['time'] for queue in self._queues.values() if queue]
+    return min(times) if times else None
+
+  def getJson(self, path):
+    with self._lock:
+      queue = self._queues.get(path)
+      if not queue:
+        self._misses += 1
+        raise EOFError("End of the recording of %s" % (path))
+      record = queue.popleft()
+      self._misses = 0
+      if self._start is None:
+        self._start = time.time()
+      if self.started is None:
+        self.started = record['time']
+
+    if self._realtime:
+      time.sleep(max(0, self._start + record['time'] - self._first + record['ms'] / 1000 - time.time()))
+
+    if 'error' in record:
+      raise (socket.timeout if record['timeout'] else ConnectionError)(record['error'])
+
+    received = time.perf_counter()
+    data = decodeResponse('replay:', path, record['status'], record['body'])
+    if self._stats is not None:
+      self._stats.record('rtt', record['ms'] / 1000)
+      self._stats.record('decode', time.perf_counter() - received)
+    return data
+
+  def connectionStats(self):
+    return (0, 0)
+
+  def close(self):
+    pass
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# import normal packages
+import random
+from gi.repository import GLib
+
+
+class PollScheduler:
+  """Decides when the next request to the Shelly is started.
+
+  The timer is a one-shot that is only armed again once the previous
+  request completed, so requests never overlap. While the power changes by
+  more than `threshold` W per sample the interval stays at `minInterval`,
+  while it is flat the interval slowly grows up to `maxInterval`. After
+  failed requests the delay doubles up to `maxBackoff` ms, with jitter so
+  several meters do not retry in lockstep."""
+  def __init__(self, poll, interval=250, minInterval=250, maxInterval=1000, threshold=20, maxBackoff=60000):
+    self._poll = poll
+    self.configure(interval, minInterval, maxInterval, threshold, maxBackoff)
+    self._interval = self._baseInterval
+    self._failures = 0
+    self._timer = None
+
+  def configure(self, interval, minInterval, maxInterval, threshold, maxBackoff):
+    self._baseInterval = min(max(interval, minInterval), maxInterval)
+    self._minInterval = minInterval
+    self._maxInterval = maxInterval
+    self._threshold = threshold
+    self._maxBackoff = maxBackoff
+
+  @property
+  def interval(self):
+    return self._interval
+
+  @property
+  def failures(self):
+    return self._failures
+
+  def start(self):
+    self._arm(0)
+
+  def _arm(self, delay):
+    if self._timer is not None:
+      GLib.source_remove(self._timer)
+    self._timer = GLib.timeout_add(int(delay), self._fire)
+
+  def _fire(self):
+    self._timer = None
+    self._poll()
+    # one-shot, armed again by completed()
+    return False
+
+  def skip(self):
+    """No request was started this time, check again after the current interval."""
+    self._arm(self._interval)
+
+  def completed(self, success, powerChange=0):
+    """Called when a request finished, arms the timer for the next one."""
+    if success:
+      self._failures = 0
+      if abs(powerChange) > self._threshold:
+        self._interval = self._minInterval
+      else:
+        self._interval = min(self._maxInterval, max(self._interval, self._baseInterval) * 1.25)
+      delay = self._interval
+    else:
+      self._failures += 1
+      backoff = min(self._maxBackoff, self._baseInterval * 2 ** min(self._failures, 16))
+      delay = backoff / 2 + random.uniform(0, backoff / 2)
+
+    self._arm(delay)
+    return delay
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# import normal packages
+import json
+import logging
+import os
+
+
+# seconds between writes of the snapshot
+SNAPSHOT_INTERVAL = 300
+
+
+def loadJson(path):
+  """Returns the content of the JSON file, {} if it does not exist or can not be read."""
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except FileNotFoundError:
+    return {}
+  except Exception as e:
+    logging.warning("Can not read %s: %s", path, e)
+    return {}
+
+
+def saveFile(path, data):
+  """Writes the bytes next to the file and renames it, a power loss leaves either the old or the new file."""
+  try:
+    with open(path + '.tmp', 'wb') as f:
+      f.write(data)
+    os.replace(path + '.tmp', path)
+    return True
+  except OSError as e:
+    logging.warning("Can not write %s: %s", path, e)
+    return False
+
+
+def saveJson(path, data):
+  return saveFile(path, json.dumps(data).encode('utf-8'))
+
+
+class Snapshot:
+  """Last known good state of one Shelly - its serial and the last
+  published values of its meters - so the services can be registered on
+  D-Bus at startup before the Shelly answered."""
+  def __init__(self, path):
+    self._path = path
+    data = loadJson(path)
+    self.serial = data.get('serial')
+    self.meters = data.get('meters', {}) # meter name -> dict path -> value
+    self.time = data.get('time', 0)
+
+  def save(self, serial, meters, timestamp):
+    if saveJson(self._path, {'serial': serial, 'meters': meters, 'time': timestamp}):
+      self.serial, self.meters, self.time = serial, meters, timestamp
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+# import normal packages
+import logging
+import threading
+import time
+from array import array
+from gi.repository import GLib
+
+
+QUANTILES = (('P50', 0.5), ('P95', 0.95), ('P99', 0.99))
+
+# stage -> D-Bus name, all in ms
+HISTOGRAMS = (
+  ('rtt', 'Rtt'),         # HTTP request until the body is read, per request
+  ('decode', 'Decode'),   # JSON decode, per request
+  ('publish', 'Publish'), # D-Bus publish of one sample on all services of a device
+  ('tick', 'Tick'),       # start of the request until the sample is published
+  ('lag', 'Lag'),         # main loop lag, the same for all devices
+)
+COUNTERS = (
+  ('errors', 'Errors'),   # failed ticks
+  ('timeouts', 'Timeouts'), # failed ticks because the Shelly did not answer in time
+  ('skipped', 'Skipped'), # ticks skipped because the previous request was still running
+)
+
+STATS_PATHS = tuple('/Mgmt/Stats/%s/%s' % (name, quantile) for key, name in HISTOGRAMS for quantile, q in QUANTILES) + \
+              tuple('/Mgmt/Stats/%s' % (name) for key, name in COUNTERS)
+
+
+class Histogram:
+  """The last `size` samples in a ring, percentiles are only computed when asked for.
+  add() is O(1) and may be called from the worker threads."""
+  def __init__(self, size=1024):
+    self._samples = array('d', bytes(8 * size))
+    self._lock = threading.Lock()
+    self._next = 0
+    self.count = 0 # samples ever added
+
+  def add(self, value):
+    with self._lock:
+      self._samples[self._next] = value
+      self._next = (self._next + 1) % len(self._samples)
+      self.count += 1
+
+  def percentiles(self):
+    """Returns (p50, p95, p99) of the samples in the window, None if there are none."""
+    with self._lock:
+      samples = sorted(self._samples[:min(self.count, len(self._samples))])
+    if not samples:
+      return (None,) * len(QUANTILES)
+    return tuple(samples[min(len(samples) - 1, int(q * len(samples)))] for quantile, q in QUANTILES)
+
+
+class Stats:
+  """Timings and counters of one Shelly."""
+  def __init__(self, lag=None):
+    self.histograms = dict((key, Histogram()) for key, name in HISTOGRAMS if key != 'lag')
+    self.histograms['lag'] = lag or Histogram()
+    self.counters = dict.fromkeys([key for key, name in COUNTERS], 0)
+
+  def record(self, key, seconds):
+    self.histograms[key].add(seconds * 1000)
+
+  def count(self, key):
+    self.counters[key] += 1
+
+  def values(self):
+    """Returns the dict D-Bus path -> value, /Latency is the median tick time."""
+    values = {}
+    for key, name in HISTOGRAMS:
+      for (quantile, q), value in zip(QUANTILES, self.histograms[key].percentiles()):
+        values['/Mgmt/Stats/%s/%s' % (name, quantile)] = None if value is None else round(value, 2)
+    for key, name in COUNTERS:
+      values['/Mgmt/Stats/%s' % (name)] = self.counters[key]
+    values['/Latency'] = values['/Mgmt/Stats/Tick/P50']
+    return values
+
+  def summary(self):
+    return "tick p50/p95/p99 %s/%s/%s ms, rtt p50 %s ms, lag p99 %s ms, errors %d, timeouts %d, skipped %d" % (
+      self.histograms['tick'].percentiles() + self.histograms['rtt'].percentiles()[:1] + self.histograms['lag'].percentiles()[2:] +
+      (self.counters['errors'], self.counters['timeouts'], self.counters['skipped']))
+
+
+class LagProbe:
+  """Measures how late a short GLib timer fires, i.e. how long the main loop was busy."""
+  def __init__(self, interval=100):
+    self.histogram = Histogram()
+    self._interval = interval / 1000
+    self._expected = time.monotonic() + self._interval
+    GLib.timeout_add(interval, self._probe)
+
+  def _probe(self):
+    now = time.monotonic()
+    self.histogram.add(max(0, now - self._expected) * 1000)
+    self._expected = now + self._interval
+    return True
+
+
+class MetricsServer:
+  """Text metrics in the Prometheus exposition format on http://<host>:<port>/metrics,
+  served on its own thread so a slow scraper never holds up the main loop."""
+  def __init__(self, port, devices, host='127.0.0.1'):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # only imported with MetricsPort
+    
+    self._devices = devices # tuple of (label, Stats)
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+          self.send_error(404)
+          return
+        data = server.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+      def log_message(self, format, *args):
+        pass
+
+    self._server = ThreadingHTTPServer((host, port), Handler)
+    self._server.daemon_threads = True
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    logging.info("Metrics on http://%s:%d/metrics", host, port)
+
+  def render(self):
+    lines = []
+    for key, name in HISTOGRAMS:
+      metric = 'shelly_em_%s_ms' % (key)
+      lines.append('# TYPE %s summary' % (metric))
+      # the main loop lag is shared by all devices
+      devices = [('', stats) for label, stats in self._devices[:1]] if key == 'lag' else self._devices
+      for label, stats in devices:
+        histogram = stats.histograms[key]
+        labels = 'device="%s",' % (label) if label else ''
+        for (quantile, q), value in zip(QUANTILES, histogram.percentiles()):
+          if value is not None:
+            lines.append('%s{%squantile="%s"} %s' % (metric, labels, q, round(value, 3)))
+        lines.append('%s_count%s %d' % (metric, '{%s}' % (labels.rstrip(',')) if label else '', histogram.count))
+    for key, name in COUNTERS:
+      metric = 'shelly_em_%s_total' % (key)
+      lines.append('# TYPE %s counter' % (metric))
+      for label, stats in self._devices:
+        lines.append('%s{device="%s"} %d' % (metric, label, stats.counters[key]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""Offline benchmark of the service: runs dbus-shelly-em-smartmeter.py on a
+real GLib main loop against tools/mock_shelly.py (in its own process, so
+it does not count against our CPU time) and the in-memory VeDbusService of
+tools/fake_vedbus.py. Needs PyGObject and requests, but neither D-Bus nor
+Venus OS.
+
+Reported per tick (one sample published on all services of a device):
+- fetch: HTTP round trip and JSON decode on the worker thread
+- publish: work on the main loop to publish one sample
+- tick: from the start of the request until the sample is published
+- main loop lag: how late a 10 ms probe timer fires
+- CPU time, memory blocks and (with --allocations) bytes allocated
+- D-Bus signals the services would have emitted
+
+  python tools/benchmark.py --duration 30 --latency 20 --jitter 10 --noise 5
+  python tools/benchmark.py --devices 4 --failure-rate 0.05 --json result.json
+"""
+
+# import normal packages
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+TOOLS = os.path.dirname(os.path.realpath(__file__))
+ROOT = os.path.join(TOOLS, '..')
+sys.path.insert(1, ROOT)
+sys.path.insert(1, TOOLS)
+
+import fake_vedbus
+
+
+CONFIG = """[DEFAULT]
+AccessType = OnPremise
+SignOfLifeLog = 0
+MaxWorkers = %(workers)d
+%(extra)s
+"""
+
+DEVICE = """
+[ONPREMISE%(suffix)s]
+Host=127.0.0.1:%(port)d
+Username=
+Password=
+
+[METER:grid%(index)d]
+Device=%(name)s
+Channel=0
+Role=grid
+Deviceinstance=%(grid)d
+CustomName=Grid %(index)d
+
+[METER:pvinverter%(index)d]
+Device=%(name)s
+Channel=1
+Role=pvinverter
+Deviceinstance=%(pvinverter)d
+CustomName=PV %(index)d
+"""
+
+
+def percentiles(values):
+  if not values:
+    return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+  values = sorted(values)
+  pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+  return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': values[-1]}
+
+
+def freePort():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+
+def startMock(args):
+  port = freePort()
+  command = [sys.executable, os.path.join(TOOLS, 'mock_shelly.py'), '--port', str(port),
+             '--latency', str(args.latency), '--jitter', str(args.jitter),
+             '--failure-rate', str(args.failure_rate), '--failure-mode', args.failure_mode, '--noise', str(args.noise)]
+  mock = subprocess.Popen(command, stdout=subprocess.PIPE)
+  mock.stdout.readline() # started
+  return mock, port
+
+
+def loadService(batched):
+  fake_vedbus.install(batched)
+  try:
+    import dbus
+  except ImportError:
+    # the stand-in services never touch the bus
+    sys.modules['dbus'] = types.ModuleType('dbus')
+
+  spec = importlib.util.spec_from_file_location('dbus_shelly_em_smartmeter', os.path.join(ROOT, 'dbus-shelly-em-smartmeter.py'))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  module.dbusconnection = lambda: None
+  return module
+
+
+class Probe:
+  """Collects the measurements, patched into ShellyemPoller."""
+  def __init__(self, allocations):
+    self.lock = threading.Lock()
+    self.fetch = []
+    self.publish = []
+    self.tick = []
+    self.lag = []
+    self.errors = 0
+    self.allocations = allocations
+    self.allocated = []
+
+  def install(self, poller):
+    probe = self
+    getShellyData, publish = poller._getShellyData, poller._publish
+
+    def _getShellyData(self):
+      started = time.perf_counter()
+      meter_data = getShellyData(self)
+      with probe.lock:
+        probe.fetch.append(time.perf_counter() - started)
+      return meter_data
+
+    def _publish(self, meter_data, error, started, pushed=False):
+      if probe.allocations:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+      begin = time.perf_counter()
+      publish(self, meter_data, error, started, pushed)
+      end = time.perf_counter()
+      if probe.allocations:
+        probe.allocated.append(tracemalloc.get_traced_memory()[1] - before)
+      if error is not None:
+        probe.errors += 1
+      else:
+        probe.publish.append(end - begin)
+        probe.tick.append(time.time() - started)
+
+    poller._getShellyData = _getShellyData
+    poller._publish = _publish
+
+  def startLagProbe(self, GLib, interval=10):
+    expected = [time.monotonic() + interval / 1000]
+    def _probe():
+      now = time.monotonic()
+      self.lag.append(max(0, now - expected[0]))
+      expected[0] = now + interval / 1000
+      return True
+    GLib.timeout_add(interval, _probe)
+
+
+def run(args):
+  from gi.repository import GLib
+
+  mock, port = startMock(args)
+  try:
+    module = loadService(not args.unbatched)
+    devices = ''.join(DEVICE % {'suffix': ':d%d' % (index) if index else '', 'name': 'd%d' % (index) if index else '',
+                                'index': index, 'port': port, 'grid': 40 + index, 'pvinverter': 80 + index}
+                      for index in range(args.devices))
+    workers = args.workers or min(4, args.devices)
+    configfile = os.path.join(tempfile.mkdtemp(), 'config.ini')
+    with open(configfile, 'w') as f:
+      f.write(CONFIG % {'workers': workers, 'extra': '\n'.join(args.set)} + devices)
+
+    settings = module.loadSettings(configfile)
+    probe = Probe(args.allocations)
+    probe.install(module.ShellyemPoller)
+    if args.allocations:
+      tracemalloc.start()
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pollers = [module.ShellyemPoller(settings, device, module.dbuspaths(), executor) for device in settings.devices]
+    probe.startLagProbe(GLib)
+
+    mainloop = GLib.MainLoop()
+    GLib.timeout_add(int(args.duration * 1000), mainloop.quit)
+    cpu, blocks, wall = time.process_time(), sys.getallocatedblocks(), time.time()
+    mainloop.run()
+    cpu, blocks, wall = time.process_time() - cpu, sys.getallocatedblocks() - blocks, time.time() - wall
+    executor.shutdown(wait=False)
+  finally:
+    mock.terminate()
+
+  services = fake_vedbus.UnbatchedVeDbusService.services
+  ticks = len(probe.tick)
+  perTick = lambda value: value / ticks if ticks else None
+  ms = lambda values: dict((key, None if value is None else round(value * 1000, 3)) for key, value in percentiles(values).items())
+  return {
+    'duration_s': round(wall, 2),
+    'devices': args.devices,
+    'ticks': ticks,
+    'ticks_per_s': round(ticks / wall, 2),
+    'errors': probe.errors,
+    'fetch_ms': ms(probe.fetch),
+    'publish_ms': ms(probe.publish),
+    'tick_ms': ms(probe.tick),
+    'mainloop_lag_ms': ms(probe.lag),
+    'cpu_ms_per_tick': perTick(cpu * 1000),
+    'memory_blocks_per_tick': perTick(blocks),
+    'allocated_bytes_per_publish': percentiles(probe.allocated) if args.allocations else None,
+    'rss_max_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'signals': sum(service.signals for service in services),
+    'signals_per_tick': perTick(sum(service.signals for service in services)),
+    'item_writes_per_tick': perTick(sum(service.writes for service in services)),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--duration', type=float, default=30, help='seconds to run')
+  parser.add_argument('--devices', type=int, default=1, help='number of Shellys (all served by one mock)')
+  parser.add_argument('--workers', type=int, default=0, help='MaxWorkers, default min(4, devices)')
+  parser.add_argument('--latency', type=float, default=0, help='ms added by the mock to every response')
+  parser.add_argument('--jitter', type=float, default=0, help='+/- ms of random latency')
+  parser.add_argument('--failure-rate', type=float, default=0, help='share of requests that fail, 0..1')
+  parser.add_argument('--failure-mode', choices=('http500', 'reset', 'timeout'), default='http500')
+  parser.add_argument('--noise', type=float, default=0, help='W of random walk on the power per request')
+  parser.add_argument('--unbatched', action='store_true', help='VeDbusService without ItemsChanged')
+  parser.add_argument('--allocations', action='store_true', help='trace the bytes allocated per publish (slow)')
+  parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='extra [DEFAULT] line for config.ini, e.g. PollInterval=100')
+  parser.add_argument('--json', metavar='FILE', help='also write the result to this file')
+  parser.add_argument('--verbose', action='store_true', help='show the log of the service')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+
+  result = run(args)
+  for key, value in result.items():
+    print("%-28s %s" % (key, value))
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""In-memory stand-in for velib_python's vedbus.VeDbusService, to run the
+service without D-Bus. It keeps the values of all paths and counts the
+signals the real service would emit:
+
+- an item write that changes the value: one PropertiesChanged
+- a `with service as ctx:` block with changes: one ItemsChanged
+
+Installed with install() before the service script is imported.
+"""
+
+# import normal packages
+import sys
+import types
+
+
+class ServiceContext:
+  def __init__(self, parent):
+    self.parent = parent
+    self.changes = {}
+
+  def __getitem__(self, path):
+    return self.parent[path]
+
+  def __setitem__(self, path, value):
+    if self.parent._set(path, value):
+      self.changes[path] = value
+
+
+class UnbatchedVeDbusService:
+  """velib versions before ItemsChanged, without context manager."""
+  # all services created, for the report
+  services = []
+
+  def __init__(self, servicename, bus=None, register=True):
+    self.servicename = servicename
+    self.values = {}
+    self.callbacks = {}
+    self.propertiesChanged = 0
+    self.itemsChanged = 0
+    self.writes = 0
+    UnbatchedVeDbusService.services.append(self)
+
+  def add_path(self, path, value, description="", writeable=False, onchangecallback=None, gettextcallback=None, valuetype=None, itemtype=None):
+    self.values[path] = value
+    self.callbacks[path] = (onchangecallback, gettextcallback)
+
+  def register(self):
+    pass
+
+  @property
+  def signals(self):
+    return self.propertiesChanged + self.itemsChanged
+
+  def _set(self, path, value):
+    self.writes += 1
+    if path not in self.values:
+      raise KeyError(path)
+    if self.values[path] == value:
+      return False
+    self.values[path] = value
+    gettext = self.callbacks[path][1]
+    if gettext is not None and value is not None:
+      gettext(path, value) # the real service formats the text of every change
+    return True
+
+  def __getitem__(self, path):
+    return self.values[path]
+
+  def __setitem__(self, path, value):
+    if self._set(path, value):
+      self.propertiesChanged += 1
+
+  def __delitem__(self, path):
+    del self.values[path]
+
+
+class VeDbusService(UnbatchedVeDbusService):
+  def __init__(self, servicename, bus=None, register=True):
+    UnbatchedVeDbusService.__init__(self, servicename, bus, register)
+    self._contexts = []
+
+  def __enter__(self):
+    context = ServiceContext(self)
+    self._contexts.append(context)
+    return context
+
+  def __exit__(self, *exc):
+    if self._contexts.pop().changes:
+      self.itemsChanged += 1
+
+
+def install(batched=True):
+  """Makes `from vedbus import VeDbusService` return the stand-in."""
+  module = types.ModuleType('vedbus')
+  module.VeDbusService = VeDbusService if batched else UnbatchedVeDbusService
+  sys.modules['vedbus'] = module
+  return module.VeDbusService
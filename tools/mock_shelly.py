@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""Mock Shelly EM serving /status, /emeter/<i> and /shelly from a /status
+document (default docs/shellyem-status-sample.json), with configurable
+latency, jitter, failures and noise on the power values.
+
+  python tools/mock_shelly.py --port 8080 --latency 20 --jitter 10 --failure-rate 0.01
+"""
+
+# import normal packages
+import argparse
+import copy
+import json
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+SAMPLE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'docs', 'shellyem-status-sample.json')
+
+
+class MockShelly:
+  def __init__(self, status, latency=0, jitter=0, failureRate=0, failureMode='http500', noise=0):
+    self._status = status
+    self._lock = threading.Lock()
+    self.latency = latency / 1000
+    self.jitter = jitter / 1000
+    self.failureRate = failureRate
+    self.failureMode = failureMode # http500, reset or timeout
+    self.noise = noise             # W of random walk per request
+    self.requests = 0
+
+  def sample(self):
+    with self._lock:
+      self.requests += 1
+      if self.noise:
+        for emeter in self._status['emeters']:
+          emeter['power'] = round(emeter['power'] + random.uniform(-self.noise, self.noise), 2)
+          emeter['total'] = round(emeter['total'] + abs(emeter['power']) / 14400, 1)
+      return copy.deepcopy(self._status)
+
+  def handler(self):
+    mock = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1' # keep-alive, like the Shelly
+
+      def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # headers and body are written separately, without this every response waits for a delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+      def do_GET(self):
+        delay = mock.latency + random.uniform(-mock.jitter, mock.jitter)
+        if delay > 0:
+          time.sleep(delay)
+
+        if mock.failureRate and random.random() < mock.failureRate:
+          if mock.failureMode == 'reset':
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.close_connection = True
+            return
+          if mock.failureMode == 'timeout':
+            time.sleep(30)
+            return
+          return self._send(500, {})
+
+        status = mock.sample()
+        if self.path == '/status':
+          return self._send(200, status)
+        if self.path.startswith('/emeter/'):
+          try:
+            return self._send(200, status['emeters'][int(self.path[len('/emeter/'):])])
+          except (ValueError, IndexError):
+            pass
+        if self.path == '/shelly':
+          return self._send(200, {'type': 'SHEM', 'mac': status['mac'], 'auth': False, 'fw': 'mock'})
+        self._send(404, {})
+
+      def _send(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+      def log_message(self, format, *args):
+        pass
+
+    return Handler
+
+  def serve(self, port=0, host='127.0.0.1'):
+    """Starts the server on a thread, returns the port."""
+    self._server = ThreadingHTTPServer((host, port), self.handler())
+    self._server.daemon_threads = True
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    return self._server.server_address[1]
+
+  def shutdown(self):
+    self._server.shutdown()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--status', default=SAMPLE, help='/status document to serve')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--latency', type=float, default=0, help='ms added to every response')
+  parser.add_argument('--jitter', type=float, default=0, help='+/- ms of random latency')
+  parser.add_argument('--failure-rate', type=float, default=0, help='share of requests that fail, 0..1')
+  parser.add_argument('--failure-mode', choices=('http500', 'reset', 'timeout'), default='http500')
+  parser.add_argument('--noise', type=float, default=0, help='W of random walk on the power per request')
+  args = parser.parse_args()
+
+  with open(args.status) as f:
+    status = json.load(f)
+  mock = MockShelly(status, args.latency, args.jitter, args.failure_rate, args.failure_mode, args.noise)
+  port = mock.serve(args.port)
+  print("Mock Shelly EM on 127.0.0.1:%d" % (port), flush=True)
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    mock.shutdown()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""Replays a recording of the service (RecordFile of config.ini) through
+the pollers and services of dbus-shelly-em-smartmeter.py, on a PC without
+D-Bus and Venus OS (the in-memory VeDbusService of tools/fake_vedbus.py).
+Only PyGObject is needed.
+
+The [ONPREMISE] and [METER] sections come from --config, which has to
+name the Shellys as in the recording; Push, Discovery, History and the
+recording itself are switched off, the state files go to a temporary
+directory.
+
+By default the responses are replayed as fast as possible on this thread,
+with the recorded timestamps: the values published are the same on every
+run, their SHA-256 is printed (and with --output every sample is written
+as a JSON line) to compare versions, and samples/s is the throughput of
+parse and publish. With --realtime the polls run on the main loop and the
+worker threads as in the service, the responses come at the recorded pace.
+
+  python tools/replay_recording.py recording.gz --config config.ini
+  python tools/replay_recording.py recording.gz --output before.jsonl
+  python tools/replay_recording.py recording.gz --realtime
+"""
+
+# import normal packages
+import argparse
+import configparser
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+TOOLS = os.path.dirname(os.path.realpath(__file__))
+ROOT = os.path.join(TOOLS, '..')
+sys.path.insert(1, ROOT)
+sys.path.insert(1, TOOLS)
+
+import fake_vedbus
+from shelly_record import ReplayClient, readRecording
+
+
+def loadService():
+  fake_vedbus.install()
+  try:
+    import dbus
+  except ImportError:
+    # the stand-in services never touch the bus
+    sys.modules['dbus'] = types.ModuleType('dbus')
+
+  spec = importlib.util.spec_from_file_location('dbus_shelly_em_smartmeter', os.path.join(ROOT, 'dbus-shelly-em-smartmeter.py'))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  module.dbusconnection = lambda: None
+  return module
+
+
+def override(config, section, values):
+  # the keys of config.ini are case-insensitive, replace them in any case
+  names = [name.lower() for name in values]
+  for key in list(config[section]):
+    if key.lower() in names:
+      config.remove_option(section, key)
+  config[section].update(values)
+
+
+def writeConfig(path, directory):
+  # the config.ini of the recording, without anything that talks to the outside
+  config = configparser.ConfigParser(interpolation=None)
+  config.optionxform = str # written back, the paths of [DEADBAND] keep their case
+  if not config.read(path):
+    sys.exit("Can not read %s" % (path))
+  override(config, 'DEFAULT', {'SignOfLifeLog': '0', 'History': '0', 'Discovery': '0', 'RecordFile': '',
+                                'MetricsPort': '0', 'StatsInterval': '0', 'StateDirectory': directory})
+  for section in config.sections():
+    if section == 'ONPREMISE' or section.startswith('ONPREMISE:'):
+      override(config, section, {'Host': 'replay', 'Push': 'none'})
+  configfile = os.path.join(directory, 'config.ini')
+  with open(configfile, 'w') as f:
+    config.write(f)
+  return configfile
+
+
+class Output:
+  """Collects the values of every sample published, patched into DbusShellyemService."""
+  def __init__(self, module, path):
+    self.samples = 0
+    self.digest = hashlib.sha256()
+    self.file = open(path, 'w') if path else None
+    output = self
+    update = module.DbusShellyemService._update
+
+    def _update(self, meter_data, timestamp, energy=True):
+      update(self, meter_data, timestamp, energy)
+      output.add(self._servicename, timestamp, self._lastValues)
+    module.DbusShellyemService._update = _update
+
+  def add(self, servicename, timestamp, values):
+    line = json.dumps({'service': servicename, 'time': timestamp, 'values': values}, sort_keys=True)
+    self.digest.update(line.encode('utf-8'))
+    self.samples += 1
+    if self.file is not None:
+      self.file.write(line + '\n')
+
+
+def replayFast(pollers, clients):
+  """Replays the responses in recorded order, returns (samples, errors)."""
+  samples = errors = 0
+  while True:
+    pending = [(clients[poller._device.name].nextTime(), index) for index, poller in enumerate(pollers)
+               if not clients[poller._device.name].done()]
+    if not pending:
+      return samples, errors
+    poller = pollers[min(pending)[1]]
+    client = clients[poller._device.name]
+
+    client.started = None
+    try:
+      meter_data, error = poller._getShellyData(), None
+    except EOFError:
+      continue
+    except Exception as e:
+      meter_data, error = None, e
+    poller._publish(meter_data, error, client.started)
+    if error is None:
+      samples += 1
+    else:
+      errors += 1
+
+
+def replayRealtime(GLib, clients, probe):
+  mainloop = GLib.MainLoop()
+  def _check():
+    if all(client.done() for client in clients.values()):
+      mainloop.quit()
+    return True
+  GLib.timeout_add(100, _check)
+  mainloop.run()
+  return probe['samples'], probe['errors']
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('recording', help='RecordFile written by the service')
+  parser.add_argument('--config', default=os.path.join(ROOT, 'config.ini'), help='config.ini the recording was made with')
+  parser.add_argument('--realtime', action='store_true', help='replay at the recorded pace through the main loop')
+  parser.add_argument('--output', metavar='FILE', help='write every published sample as a JSON line')
+  parser.add_argument('--json', metavar='FILE', help='also write the result to this file')
+  parser.add_argument('--verbose', action='store_true', help='show the log of the service')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL + 1)
+  from gi.repository import GLib
+
+  recording = readRecording(args.recording)
+  module = loadService()
+  settings = module.loadSettings(writeConfig(args.config, tempfile.mkdtemp()))
+  missing = [device.name or 'ONPREMISE' for device in settings.devices if device.name not in recording]
+  if missing:
+    sys.exit("The recording has no responses of %s" % (', '.join(missing)))
+
+  # the pollers get a ReplayClient instead of the HTTP client
+  clients = dict((device.name, ReplayClient(recording[device.name], args.realtime)) for device in settings.devices)
+  module.ShellyemPoller._getShellyClient = lambda self, settings, device: clients[device.name]
+  output = Output(module, args.output)
+  probe = {'samples': 0, 'errors': 0}
+  publish = module.ShellyemPoller._publish
+  def _publish(self, meter_data, error, started, pushed=False):
+    probe['errors' if error is not None else 'samples'] += 1
+    publish(self, meter_data, error, started, pushed)
+  if args.realtime:
+    module.ShellyemPoller._publish = _publish
+
+  executor = ThreadPoolExecutor(max_workers=max(1, settings.maxWorkers))
+  aggregates = []
+  if settings.aggregates:
+    from shelly_aggregate import AggregateMeter
+    for meter in settings.aggregates:
+      aggregates.append(AggregateMeter(meter, module.meterservice(settings, meter, module.dbuspaths(), 'virtual-%s' % (meter.name), executor=executor),
+                                       settings.aggregateWindow, settings.aggregateStale,
+                                       os.path.join(settings.stateDirectory, '%s.sources.json' % (meter.name)), executor))
+  pollers = [module.ShellyemPoller(settings, device, module.dbuspaths(), executor, aggregates=aggregates) for device in settings.devices]
+
+  started = time.perf_counter()
+  if args.realtime:
+    samples, errors = replayRealtime(GLib, clients, probe)
+  else:
+    # the serial is read first, as in the service
+    while any(poller._identify.busy() for poller in pollers):
+      time.sleep(0.01)
+    samples, errors = replayFast(pollers, clients)
+  wall = time.perf_counter() - started
+  executor.shutdown(wait=False)
+  if output.file is not None:
+    output.file.close()
+
+  result = {
+    'mode': 'realtime' if args.realtime else 'fast',
+    'responses': sum(len(records) for records in recording.values()),
+    'samples': samples,
+    'errors': errors,
+    'duration_s': round(wall, 3),
+    'samples_per_s': round(samples / wall, 1) if wall > 0 else None,
+    'published': output.samples,
+    'sha256': output.digest.hexdigest(),
+  }
+  for key, value in result.items():
+    print("%-28s %s" % (key, value))
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Lists the Shelly EMs on the network - those announcing themselves on
+mDNS and, with --subnet, those answering /shelly on a host of the subnet -
+as [ONPREMISE] sections to paste into config.ini.
+
+  python tools/shelly_discover.py
+  python tools/shelly_discover.py --subnet 192.168.1.0/24
+"""
+
+# import normal packages
+import argparse
+import os
+import sys
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from shelly_discovery import Discovery
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--subnet', help='also probe every host of this subnet, e.g. 192.168.1.0/24')
+  parser.add_argument('--timeout', type=float, default=1.0, help='seconds to wait for mDNS answers and each probe')
+  args = parser.parse_args()
+
+  # no registry file, nothing is remembered
+  discovery = Discovery('', args.subnet or '', timeout=args.timeout)
+  found = dict((mac, (host, kind)) for host, mac, kind in discovery.browse())
+  if args.subnet:
+    found.update((mac, (host, kind)) for host, (mac, kind) in discovery.probeSubnet(args.subnet))
+  if not found:
+    sys.exit("No Shelly EM found")
+
+  for index, (mac, (host, kind)) in enumerate(sorted(found.items(), key=lambda item: item[1])):
+    print("[ONPREMISE%s]" % (':%s' % (mac[-6:].lower()) if index else ''))
+    print("# %s" % (kind))
+    print("Host=%s" % (host))
+    print("Mac=%s" % (mac))
+    print()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Stand-in for a Shelly EM that pushes its values, to try the Push modes of
+the service without a real device. The emeters of a /status document
+(default docs/shellyem-status-sample.json) are sent again and again as
+CoIoT frames over UDP or as MQTT messages.
+
+  python tools/shelly_push_replay.py --coiot 127.0.0.1:5683
+  python tools/shelly_push_replay.py --mqtt 127.0.0.1:1883
+"""
+
+# import normal packages
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from shelly_push import COIOT_OPTION_DEVICE, SHEM_SENSORS
+
+
+def coiotOption(delta, value):
+  # CoAP option with extended delta/length encoding
+  header, extended = [], b''
+  for number in (delta, len(value)):
+    if number < 13:
+      header.append(number)
+    elif number < 269:
+      header.append(13)
+      extended += struct.pack('!B', number - 13)
+    else:
+      header.append(14)
+      extended += struct.pack('!H', number - 269)
+  return struct.pack('!B', header[0] << 4 | header[1]) + extended + value
+
+
+def coiotFrame(deviceId, meter_data, messageId):
+  sensors = dict((value, sensor) for sensor, value in SHEM_SENSORS.items())
+  values = []
+  for channel, emeter in enumerate(meter_data['emeters']):
+    for field in ('power', 'voltage', 'total', 'total_returned'):
+      if (channel, field) in sensors:
+        values.append([0, sensors[(channel, field)], emeter[field]])
+
+  # version 1, non-confirmable, no token, code 0.30 - the code Shellys use for their status
+  header = struct.pack('!BBH', 0x50, 30, messageId & 0xFFFF)
+  return header + coiotOption(COIOT_OPTION_DEVICE, deviceId.encode('ascii')) + b'\xff' + json.dumps({'G': values}).encode('utf-8')
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--status', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'docs', 'shellyem-status-sample.json'))
+  parser.add_argument('--coiot', metavar='HOST:PORT', help='send CoIoT frames to this address')
+  parser.add_argument('--mqtt', metavar='HOST:PORT', help='publish to this MQTT broker')
+  parser.add_argument('--interval', type=float, default=1.0, help='seconds between two samples')
+  parser.add_argument('--count', type=int, default=0, help='number of samples, 0 for endless')
+  args = parser.parse_args()
+
+  with open(args.status) as f:
+    meter_data = json.load(f)
+  mac = meter_data['mac']
+
+  if args.coiot:
+    host, port = args.coiot.rsplit(':', 1)
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    send = lambda number: udp.sendto(coiotFrame('SHEM#%s#2' % (mac), meter_data, number), (host, int(port)))
+  elif args.mqtt:
+    import paho.mqtt.client as mqtt # optional dependency
+    host, port = args.mqtt.rsplit(':', 1)
+    try:
+      client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    except AttributeError:
+      client = mqtt.Client()
+    client.connect(host, int(port))
+    client.loop_start()
+    topic = 'shellies/shellyem-%s/emeter' % (mac[-6:])
+    def send(number):
+      for channel, emeter in enumerate(meter_data['emeters']):
+        for field in ('power', 'voltage', 'total', 'total_returned'):
+          client.publish('%s/%d/%s' % (topic, channel, field), str(emeter[field]))
+  else:
+    parser.error('either --coiot or --mqtt is needed')
+
+  number = 0
+  while args.count == 0 or number < args.count:
+    send(number)
+    number += 1
+    time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Startup budget of dbus-shelly-em-smartmeter.py: imports the service
+(and the HTTP client selected with --client) in a fresh interpreter with
+`python -X importtime`, and reports the import time of the modules it
+pulls in, the total, and the resident memory after the imports.
+
+Without --real, vedbus is the in-memory stand-in of tools/fake_vedbus.py,
+so it also runs on a PC without Venus OS, but vedbus and dbus (imported
+by the service at startup on Venus OS) are not measured. The startup
+budget is what --real reports on the GX.
+
+  python tools/startup_report.py --client stdlib
+  python tools/startup_report.py --client requests --top 30
+"""
+
+# import normal packages
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+TOOLS = os.path.dirname(os.path.realpath(__file__))
+ROOT = os.path.join(TOOLS, '..')
+
+# runs in the measured interpreter
+CHILD = """
+import sys, time, resource
+started = time.perf_counter()
+sys.path.insert(1, %(root)r)
+sys.path.insert(1, %(tools)r)
+if not %(real)r:
+  import fake_vedbus
+  fake_vedbus.install()
+import importlib.util
+spec = importlib.util.spec_from_file_location('dbus_shelly_em_smartmeter', %(script)r)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+module.createHttpClient(%(client)r, 'http://127.0.0.1')
+if %(real)r:
+  import dbus
+print('{"wall_ms": %%.1f, "rss_kb": %%d}' %% ((time.perf_counter() - started) * 1000, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+"""
+
+
+def parseImportTime(lines):
+  """Returns [(module, self us, cumulative us, depth)] of the `-X importtime` lines."""
+  modules = []
+  for line in lines:
+    if not line.startswith('import time:') or 'cumulative' in line:
+      continue
+    own, cumulative, name = line[len('import time:'):].split('|')
+    depth = (len(name) - len(name.lstrip()) - 1) // 2
+    modules.append((name.strip(), int(own), int(cumulative), depth))
+  return modules
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--client', choices=('requests', 'stdlib'), default='stdlib', help='HttpClient of config.ini')
+  parser.add_argument('--real', action='store_true', help='import the real vedbus and dbus of Venus OS')
+  parser.add_argument('--top', type=int, default=20, help='number of modules listed')
+  parser.add_argument('--json', metavar='FILE', help='also write the result to this file')
+  args = parser.parse_args()
+
+  code = CHILD % {'root': ROOT, 'tools': TOOLS, 'real': args.real, 'client': args.client,
+                  'script': os.path.join(ROOT, 'dbus-shelly-em-smartmeter.py')}
+  child = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+  if child.returncode != 0:
+    sys.exit(child.stderr)
+
+  modules = parseImportTime(child.stderr.splitlines())
+  result = json.loads(child.stdout.strip().splitlines()[-1])
+  result.update({
+    'client': args.client,
+    'modules': len(modules),
+    'import_ms': round(sum(own for name, own, cumulative, depth in modules) / 1000, 1),
+    # the imports of the service itself, with everything they pulled in
+    'top': [(name, round(cumulative / 1000, 1)) for name, own, cumulative, depth in
+            sorted([module for module in modules if module[3] == 0], key=lambda module: -module[2])[:args.top]],
+  })
+
+  print("%-28s %s" % ('client', result['client']))
+  print("%-28s %s" % ('modules imported', result['modules']))
+  print("%-28s %s" % ('import time ms', result['import_ms']))
+  print("%-28s %s" % ('startup wall ms', result['wall_ms']))
+  print("%-28s %s" % ('rss max kb', result['rss_kb']))
+  print("\ncumulative ms of the top-level imports:")
+  for name, ms in result['top']:
+    print("  %-26s %8.1f" % (name, ms))
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+  main()